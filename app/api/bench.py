@@ -0,0 +1,288 @@
+'''
+bench.py runs micro-benchmarks against the API's database and LLM helpers
+
+    python3 bench.py search --runs 50
+    python3 bench.py tokens --texts 200
+    python3 bench.py ingest --chunks 500
+    python3 bench.py stub --port 8089 --error-rate 0.2
+
+The stub serves fake OpenAI completions and embeddings. Point the API at it with
+OPENAI_API_BASE=http://localhost:8089/v1 to exercise retries and the breaker.
+'''
+from aiohttp import web
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from sqlalchemy import bindparam, delete
+from sqlmodel import (
+    Session,
+    select,
+    text
+)
+
+from langchain import OpenAI
+from llm import (
+    get_match_nodes_query,
+    get_match_nodes_params,
+    get_token_count,
+    get_token_counts,
+    get_encoding
+)
+from helpers import insert_nodes
+from models import (
+    Document,
+    Project,
+    Node,
+    Vector,
+    get_engine
+)
+from config import (
+    DISTANCE_STRATEGY,
+    LLM_DISTANCE_THRESHOLD,
+    LLM_MIN_NODE_LIMIT,
+    VECTOR_EMBEDDINGS_COUNT
+)
+
+
+def random_embeddings():
+    return [random.uniform(-1, 1) for _ in range(VECTOR_EMBEDDINGS_COUNT)]
+
+
+def walk_plan(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from walk_plan(child)
+
+
+# -------------------------------------------------------
+# Vector search: which plan does each strategy get, and
+# how long does a search take end to end?
+# -------------------------------------------------------
+def bench_search(args):
+    with Session(get_engine()) as session:
+        for strategy in DISTANCE_STRATEGY:
+            query = get_match_nodes_query(strategy)
+            params = get_match_nodes_params(
+                random_embeddings(), args.k, args.threshold
+            )
+
+            # The match_node_* functions are plain SQL, so Postgres inlines
+            # them and EXPLAIN shows the scan over the node table itself
+            explain_query = text(f'EXPLAIN (FORMAT JSON) {query.text}').bindparams(
+                bindparam('query_embeddings', type_=Vector(VECTOR_EMBEDDINGS_COUNT))
+            )
+            explain = session.execute(explain_query, params).scalar()
+            explain = explain if isinstance(explain, list) else json.loads(explain)
+            index_names = [
+                node['Index Name']
+                for node in walk_plan(explain[0]['Plan'])
+                if 'Index Name' in node
+            ]
+
+            timings = []
+            for _ in range(args.runs):
+                params = get_match_nodes_params(
+                    random_embeddings(), args.k, args.threshold
+                )
+                start = time.perf_counter()
+                session.execute(query, params).all()
+                timings.append((time.perf_counter() - start) * 1000)
+
+            timings.sort()
+            print(
+                f'{strategy.strategy_name:<20} '
+                f'index={",".join(index_names) or "NONE (seq scan)":<40} '
+                f'p50={timings[len(timings) // 2]:.2f}ms '
+                f'p95={timings[int(len(timings) * 0.95) - 1]:.2f}ms'
+            )
+
+
+# ---------------------------------------------------------
+# Token counting: a fresh langchain OpenAI() per string vs
+# the cached tiktoken encoding, one by one and batched
+# ---------------------------------------------------------
+def bench_tokens(args):
+    words = ['support', 'account', 'password', 'billing', 'the', 'a', 'refund',
+             'order', 'shipping', 'how', 'do', 'I', 'reset', 'my', 'invoice']
+    texts = [
+        ' '.join(random.choice(words) for _ in range(args.words))
+        for _ in range(args.texts)
+    ]
+
+    get_encoding()  # warm the cache, the first load is paid once per process
+
+    def timed(fn):
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        return timings[len(timings) // 2]
+
+    paths = [
+        ('langchain OpenAI()', lambda: [OpenAI().get_num_tokens(text=t) for t in texts]),
+        ('get_token_count', lambda: [get_token_count(t) for t in texts]),
+        ('get_token_counts', lambda: get_token_counts(texts)),
+    ]
+    for name, fn in paths:
+        print(f'{name:<20} texts={len(texts)} p50={timed(fn):.2f}ms')
+
+
+# ---------------------------------------------------------
+# Node ingestion: the old per-node add/commit/refresh loop
+# vs insert_nodes() in one transaction, in chunks/sec
+# ---------------------------------------------------------
+def bench_ingest(args):
+    with Session(get_engine()) as session:
+        project = session.exec(select(Project)).first()
+        if not project:
+            raise SystemExit('bench ingest needs at least one project, run make seed first')
+
+        document = Document(
+            display_name='bench-ingest.md',
+            project_id=project.id,
+            organization_id=project.organization_id,
+            hash=f'bench-ingest-{time.time()}',
+        )
+        session.add(document)
+        session.commit()
+        session.refresh(document)
+
+        def make_nodes():
+            return [
+                Node(
+                    document_id=document.id,
+                    project_id=project.id,
+                    organization_id=project.organization_id,
+                    embeddings=random_embeddings(),
+                    text=f'bench chunk {i}',
+                    token_count=3,
+                )
+                for i in range(args.chunks)
+            ]
+
+        def per_node(nodes):
+            for node in nodes:
+                session.add(node)
+                session.commit()
+                session.refresh(node)
+
+        def bulk(nodes):
+            insert_nodes(nodes, session=session)
+            session.commit()
+
+        try:
+            for name, fn in (('per-node commit', per_node), ('insert_nodes', bulk)):
+                nodes = make_nodes()
+                start = time.perf_counter()
+                fn(nodes)
+                elapsed = time.perf_counter() - start
+                print(f'{name:<20} chunks={len(nodes)} {len(nodes) / elapsed:.1f} chunks/sec')
+        finally:
+            session.rollback()
+            session.execute(delete(Node).where(Node.document_id == document.id))
+            session.execute(delete(Document).where(Document.id == document.id))
+            session.commit()
+
+
+# ---------------------------------------------------------
+# Local OpenAI stand-in with configurable latency and errors
+# ---------------------------------------------------------
+def run_stub(args):
+    answer = json.dumps({
+        'message': 'This is a canned answer from the OpenAI stub.',
+        'tags': ['stub'],
+        'is_escalate': False,
+    })
+    pieces = [answer[i:i + 8] for i in range(0, len(answer), 8)]
+
+    async def maybe_fail():
+        await asyncio.sleep(args.latency / 1000)
+        if random.random() < args.error_rate:
+            status = random.choice([429, 500, 503])
+            return web.json_response(
+                {'error': {'message': f'stub error {status}'}},
+                status=status,
+                headers={'Retry-After': '0.1'} if status == 429 else None,
+            )
+
+    async def stream(request, to_chunk):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for piece in pieces:
+            await response.write(f'data: {json.dumps(to_chunk(piece))}\n\n'.encode())
+            await asyncio.sleep(args.token_latency / 1000)
+        await response.write(b'data: [DONE]\n\n')
+        return response
+
+    async def chat_completions(request):
+        payload = await request.json()
+        error = await maybe_fail()
+        if error:
+            return error
+        if payload.get('stream'):
+            return await stream(request, lambda piece: {'choices': [{'delta': {'content': piece}}]})
+        return web.json_response({'choices': [{'message': {'role': 'assistant', 'content': answer}}]})
+
+    async def completions(request):
+        payload = await request.json()
+        error = await maybe_fail()
+        if error:
+            return error
+        if payload.get('stream'):
+            return await stream(request, lambda piece: {'choices': [{'text': piece}]})
+        return web.json_response({'choices': [{'text': answer}]})
+
+    async def embeddings(request):
+        payload = await request.json()
+        error = await maybe_fail()
+        if error:
+            return error
+        inputs = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+        return web.json_response({
+            'data': [
+                {'index': i, 'embedding': random_embeddings()}
+                for i in range(len(inputs))
+            ]
+        })
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_post('/v1/completions', completions)
+    app.router.add_post('/v1/embeddings', embeddings)
+    web.run_app(app, port=args.port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RasaGPT API benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    search = subparsers.add_parser('search', help='Vector search plans and latency')
+    search.add_argument('--runs', type=int, default=50)
+    search.add_argument('--k', type=int, default=LLM_MIN_NODE_LIMIT)
+    search.add_argument('--threshold', type=float, default=LLM_DISTANCE_THRESHOLD)
+    search.set_defaults(func=bench_search)
+
+    tokens = subparsers.add_parser('tokens', help='Token counting throughput')
+    tokens.add_argument('--runs', type=int, default=10)
+    tokens.add_argument('--texts', type=int, default=200)
+    tokens.add_argument('--words', type=int, default=100)
+    tokens.set_defaults(func=bench_tokens)
+
+    ingest = subparsers.add_parser('ingest', help='Node insert throughput')
+    ingest.add_argument('--chunks', type=int, default=500)
+    ingest.set_defaults(func=bench_ingest)
+
+    stub = subparsers.add_parser('stub', help='Run a local OpenAI API stub')
+    stub.add_argument('--port', type=int, default=8089)
+    stub.add_argument('--latency', type=float, default=200, help='ms before each response')
+    stub.add_argument('--token-latency', type=float, default=20, help='ms between streamed chunks')
+    stub.add_argument('--error-rate', type=float, default=0.0, help='share of 429/5xx responses')
+    stub.set_defaults(func=run_stub)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,65 @@
+'''
+cache.py holds the in-process cache building blocks shared by the LLM pipeline
+'''
+from collections import OrderedDict
+from threading import Lock
+from hashlib import sha256
+from typing import (
+    Hashable,
+    Optional,
+    Any
+)
+import re
+
+_whitespace = re.compile(r'\s+')
+
+
+# -------------------------------------------
+# Normalize a user query for use in cache keys
+# -------------------------------------------
+def normalize_query(query_str: str) -> str:
+    return _whitespace.sub(' ', query_str or '').strip().lower()
+
+
+# ------------------------------------
+# sha256 cache key from its components
+# ------------------------------------
+def get_cache_key(*parts: Any) -> str:
+    return sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+# ----------------------------
+# Size bounded, thread-safe LRU
+# ----------------------------
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,126 @@
+'''
+concurrency.py holds asyncio building blocks for sharing upstream work between
+concurrent requests
+'''
+from typing import (
+    Awaitable,
+    Callable,
+    Hashable,
+    Optional,
+    Tuple,
+    List,
+    Dict,
+    Any
+)
+import asyncio
+
+from metrics import increment, observe
+
+
+# ---------------------------------------------------------
+# Collects concurrent submit() calls for up to max_wait_ms
+# or max_batch_size items, runs them through one batched
+# call and fans each result back out to its caller
+# ---------------------------------------------------------
+class MicroBatcher:
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Hashable]], Awaitable[List[Any]]],
+        max_batch_size: int,
+        max_wait_ms: float,
+        name: str = 'batcher',
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._pending: List[tuple] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, item: Hashable) -> Any:
+        if self.max_wait <= 0 and self.max_batch_size == 1:
+            return (await self.batch_fn([item]))[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[tuple]):
+        # Identical items in one window are sent once
+        items = list(dict.fromkeys(item for item, _ in batch))
+        increment(f'{self.name}.batch')
+        observe(f'{self.name}.batch_size', len(items))
+
+        # Every caller gets its result or the error, none is left waiting
+        try:
+            results = await self.batch_fn(items)
+            if len(results) != len(items):
+                raise ValueError(
+                    f'{self.name} got {len(results)} results for {len(items)} items'
+                )
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        results = dict(zip(items, results))
+        for item, future in batch:
+            if not future.done():
+                future.set_result(results[item])
+
+
+# ---------------------------------------------------------
+# Coalesces concurrent calls with the same key into a single
+# run of fn; every caller awaits the first caller's result.
+# The run is shielded, so one caller disconnecting doesn't
+# cancel it for the others
+# ---------------------------------------------------------
+class SingleFlight:
+    def __init__(self, name: str = 'single_flight'):
+        self.name = name
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        '''Returns (result, shared), shared is False for the caller that ran fn'''
+        flight = self._flights.get(key)
+        if flight is not None:
+            increment(f'{self.name}.shared')
+            return await asyncio.shield(flight), True
+
+        flight = asyncio.ensure_future(fn())
+        self._flights[key] = flight
+
+        def done(_):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            # Nobody may be left to await a failed flight
+            if not flight.cancelled():
+                flight.exception()
+
+        flight.add_done_callback(done)
+        increment(f'{self.name}.run')
+        return await asyncio.shield(flight), False
@@ -64,6 +64,17 @@ APP_LOGO = "/public/img/rasagpt-logo-1.png"
 
 FILE_UPLOAD_PATH = os.getenv("FILE_UPLOAD_PATH", "/tmp")
 
+# Uploads are streamed to disk in chunks and rejected past the size limit
+FILE_UPLOAD_MAX_SIZE = int(os.getenv("FILE_UPLOAD_MAX_SIZE", 50 * 1024 * 1024))
+FILE_UPLOAD_CHUNK_SIZE = int(os.getenv("FILE_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+# List endpoints return at most PAGE_MAX_LIMIT rows per page
+PAGE_DEFAULT_LIMIT = int(os.getenv("PAGE_DEFAULT_LIMIT", 100))
+PAGE_MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", 1000))
+
+# Raw document files are stored zstd compressed in document_data
+DOCUMENT_COMPRESSION_LEVEL = int(os.getenv("DOCUMENT_COMPRESSION_LEVEL", 3))
+
 # Database configurations
 POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
@@ -76,6 +87,20 @@ DSN = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 SU_DSN = (
     f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
+ASYNC_DSN = (
+    f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+ASYNC_SU_DSN = (
+    f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+
+# Connection pool configurations (shared by every engine in the process)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1")
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 30000))  # ms, 0 disables
 
 RASA_WEBHOOK_HOST = os.getenv("RASA_WEBHOOK_HOST", "rasa-core")
 RASA_WEBHOOK_PORT = os.getenv("RASA_WEBHOOK_PORT", 5005)
@@ -89,6 +114,61 @@ LLM_CHUNK_OVERLAP = int(os.getenv("LLM_CHUNK_OVERLAP", 20))
 LLM_DISTANCE_THRESHOLD = float(os.getenv("LLM_DISTANCE_THRESHOLD", 0.5))
 LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", 256))
 LLM_MIN_NODE_LIMIT = int(os.getenv("LLM_MIN_NODE_LIMIT", 3))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+
+# OpenAI HTTP client. OPENAI_API_BASE can point at a local stub (bench.py stub)
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))  # seconds
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 32))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 4))
+OPENAI_RETRY_BACKOFF = float(os.getenv("OPENAI_RETRY_BACKOFF", 0.5))  # seconds, doubled per attempt
+OPENAI_RETRY_MAX_BACKOFF = float(os.getenv("OPENAI_RETRY_MAX_BACKOFF", 20))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))  # in-flight requests, all models; async and sync calls each get this many
+OPENAI_MODEL_CONCURRENCY = int(os.getenv("OPENAI_MODEL_CONCURRENCY", 8))  # in-flight requests per model
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", 5))  # consecutive failures to open
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", 30))  # seconds before a trial request
+
+# Document embeddings: texts per request, capped by the provider's token limit
+# per request, with up to CONCURRENCY requests in flight per document
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 100))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 250000))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 4))
+
+# Document ingestion workers (worker.py): processes per container, idle poll
+# interval, attempts per job, base retry delay and when a RUNNING job whose
+# worker stopped reporting progress is handed to another worker
+INGEST_WORKER_PROCESSES = int(os.getenv("INGEST_WORKER_PROCESSES", 2))
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", 1))  # seconds
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", 3))
+INGEST_RETRY_DELAY = int(os.getenv("INGEST_RETRY_DELAY", 30))  # seconds, doubled per attempt
+INGEST_JOB_TIMEOUT = int(os.getenv("INGEST_JOB_TIMEOUT", 600))  # seconds
+INGEST_INDEX_CHECK_INTERVAL = int(os.getenv("INGEST_INDEX_CHECK_INTERVAL", 300))  # seconds between vector index checks
+
+# Concurrent query embeddings are sent to OpenAI together: a batch closes after
+# WAIT_MS or once it holds BATCH_SIZE queries (size 1 and wait 0 disables it)
+EMBEDDING_QUERY_BATCH_SIZE = int(os.getenv("EMBEDDING_QUERY_BATCH_SIZE", 64))
+EMBEDDING_QUERY_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_QUERY_BATCH_WAIT_MS", 5))
+
+# Query embedding cache: in-process LRU, backed by the embedding_cache table
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() in ("true", "1")
+EMBEDDING_CACHE_PERSIST = os.getenv("EMBEDDING_CACHE_PERSIST", "true").lower() in ("true", "1")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+
+# Semantic answer cache: reuse a recent, non-escalated answer from the same
+# project when a new query's embedding is within THRESHOLD cosine similarity
+LLM_SEMANTIC_CACHE_ENABLED = os.getenv("LLM_SEMANTIC_CACHE_ENABLED", "false").lower() in ("true", "1")
+LLM_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", 0.95))
+LLM_SEMANTIC_CACHE_TTL = int(os.getenv("LLM_SEMANTIC_CACHE_TTL", 86400))  # seconds
+
+# Exact response cache: same normalized query, same retrieved nodes, same model
+# and temperature returns the stored LLM answer. In-process LRU over response_cache
+LLM_RESPONSE_CACHE_ENABLED = os.getenv("LLM_RESPONSE_CACHE_ENABLED", "true").lower() in ("true", "1")
+LLM_RESPONSE_CACHE_SIZE = int(os.getenv("LLM_RESPONSE_CACHE_SIZE", 10000))
+
+# Identical chat queries (project, normalized query, model) in flight at the
+# same time share one embedding, search and completion
+LLM_COALESCE_ENABLED = os.getenv("LLM_COALESCE_ENABLED", "true").lower() in ("true", "1")
 
 
 class DISTANCE_STRATEGY(Enum):
@@ -106,24 +186,30 @@ class DISTANCE_STRATEGY(Enum):
         return self.value
 
 
+class VECTOR_INDEX_TYPE(Enum):
+    IVFFLAT = "ivfflat"
+    HNSW = "hnsw"
+
+
+# (strategy, function suffix, distance operator, index operator class)
 DISTANCE_STRATEGIES = [
     (
         DISTANCE_STRATEGY.EUCLIDEAN,
         "euclidean",
         "<->",
-        "CREATE INDEX ON node USING ivfflat (embeddings vector_l2_ops) WITH (lists = 100);",
+        "vector_l2_ops",
     ),
     (
         DISTANCE_STRATEGY.COSINE,
         "cosine",
         "<=>",
-        "CREATE INDEX ON node USING ivfflat (embeddings vector_cosine_ops) WITH (lists = 100);",
+        "vector_cosine_ops",
     ),
     (
         DISTANCE_STRATEGY.MAX_INNER_PRODUCT,
         "max_inner_product",
         "<#>",
-        "CREATE INDEX ON node USING ivfflat (embeddings vector_ip_ops) WITH (lists = 100);",
+        "vector_ip_ops",
     ),
 ]
 LLM_DEFAULT_DISTANCE_STRATEGY = DISTANCE_STRATEGY[
@@ -131,17 +217,69 @@ LLM_DEFAULT_DISTANCE_STRATEGY = DISTANCE_STRATEGY[
 ]
 VECTOR_EMBEDDINGS_COUNT = 1536
 PGVECTOR_ADD_INDEX = True if os.getenv("PGVECTOR_ADD_INDEX", False) else False
+PGVECTOR_INDEX_TYPE = VECTOR_INDEX_TYPE(os.getenv("PGVECTOR_INDEX_TYPE", "ivfflat"))
+# Only build indexes for the strategies actually queried (comma separated)
+PGVECTOR_INDEX_STRATEGIES = [
+    DISTANCE_STRATEGY[strategy.strip()]
+    for strategy in os.getenv(
+        "PGVECTOR_INDEX_STRATEGIES", LLM_DEFAULT_DISTANCE_STRATEGY.name
+    ).split(",")
+    if strategy.strip()
+]
+PGVECTOR_IVFFLAT_LISTS = int(os.getenv("PGVECTOR_IVFFLAT_LISTS", 0))  # 0 sizes from row count
+PGVECTOR_HNSW_M = int(os.getenv("PGVECTOR_HNSW_M", 16))
+PGVECTOR_HNSW_EF_CONSTRUCTION = int(os.getenv("PGVECTOR_HNSW_EF_CONSTRUCTION", 64))
+# Index lifecycle: below MIN_ROWS an exact scan beats any index, and an ivfflat
+# index is retrained once the node table grows by REBUILD_FACTOR since its build
+PGVECTOR_INDEX_MIN_ROWS = int(os.getenv("PGVECTOR_INDEX_MIN_ROWS", 1000))
+PGVECTOR_INDEX_REBUILD_FACTOR = float(os.getenv("PGVECTOR_INDEX_REBUILD_FACTOR", 2.0))
+# Swapping a rebuilt index in briefly locks the node table; give up after this (ms) and retry
+PGVECTOR_INDEX_SWAP_LOCK_TIMEOUT = int(os.getenv("PGVECTOR_INDEX_SWAP_LOCK_TIMEOUT", 5000))
+PGVECTOR_INDEX_SWAP_RETRIES = int(os.getenv("PGVECTOR_INDEX_SWAP_RETRIES", 5))
+
+
+# Retrieval backend: pgvector, or an in-process index for hot projects. The
+# in-process index is per project, so only queries scoped to a project use it
+# (POST /chat/stream with a project_id); the Telegram webhook isn't tied to a
+# project and always searches pgvector
+class RETRIEVAL_BACKEND(Enum):
+    PGVECTOR = "pgvector"
+    MEMORY = "memory"
+
+
+LLM_RETRIEVAL_BACKEND = RETRIEVAL_BACKEND(os.getenv("LLM_RETRIEVAL_BACKEND", "pgvector"))
+# Project ids served from memory (comma separated), empty serves every project
+LLM_MEMORY_INDEX_PROJECTS = [
+    int(project_id)
+    for project_id in os.getenv("LLM_MEMORY_INDEX_PROJECTS", "").split(",")
+    if project_id.strip()
+]
+# Reload from Postgres after this many seconds to pick up other workers' writes
+LLM_MEMORY_INDEX_TTL = int(os.getenv("LLM_MEMORY_INDEX_TTL", 300))
+
+# Deployment-wide search defaults, set once per connection (unset = pgvector default)
+PGVECTOR_IVFFLAT_PROBES = os.getenv("PGVECTOR_IVFFLAT_PROBES")
+PGVECTOR_HNSW_EF_SEARCH = os.getenv("PGVECTOR_HNSW_EF_SEARCH")
+# pgvector >= 0.8 only: keep scanning the ANN index until enough rows pass the
+# tenant filter (relaxed_order or strict_order, unset = off)
+PGVECTOR_ITERATIVE_SCAN = os.getenv("PGVECTOR_ITERATIVE_SCAN")
+# Tenants with at most this many active nodes are ranked exactly, the ANN index's
+# candidates come from the whole table and rarely include enough of a small tenant
+PGVECTOR_EXACT_SCAN_MAX_ROWS = int(os.getenv("PGVECTOR_EXACT_SCAN_MAX_ROWS", 5000))
 # Model constants
 
 DOCUMENT_TYPE = IntEnum("DOCUMENT_TYPE", ["PLAINTEXT", "MARKDOWN", "HTML", "PDF"])
 
 ENTITY_STATUS = IntEnum(
     "ENTITY_STATUS",
-    ["UNVERIFIED", "ACTIVE", "INACTIVE", "DELETED", "BANNED" "DEPRECATED"],
+    ["UNVERIFIED", "ACTIVE", "INACTIVE", "DELETED", "BANNED", "DEPRECATED"],
 )
 CHANNEL_TYPE = IntEnum(
     "CHANNEL_TYPE", ["SMS", "TELEGRAM", "WHATSAPP", "EMAIL", "WEBSITE"]
 )
+JOB_STATUS = IntEnum(
+    "JOB_STATUS", ["QUEUED", "RUNNING", "SUCCEEDED", "FAILED"]
+)
 
 AGENT_NAMES = [
     "Aisha",
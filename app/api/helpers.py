@@ -3,24 +3,41 @@ from uuid import UUID
 import os
 
 from typing import (
+    Callable,
     Optional,
-    Union
+    Union,
+    Tuple,
+    List,
+    Dict,
+    Any
 )
 from config import (
     FILE_UPLOAD_PATH,
+    EMBEDDING_MODEL,
+    PAGE_DEFAULT_LIMIT,
+    PAGE_MAX_LIMIT,
     ENTITY_STATUS,
+    JOB_STATUS,
     logger
 )
 
 from util import (
     is_uuid,
-    get_file_hash
+    get_sha256,
+    encode_cursor,
+    decode_cursor
 )
+from metrics import increment
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.orm import noload, selectinload
 from sqlmodel import (
     Session,
     select
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import LargeBinary, delete, func, insert, type_coerce, update
 from datetime import datetime
+import vector_store
 from models import (
     Organization,
     OrganizationCreate,
@@ -31,7 +48,11 @@ from models import (
     ProjectCreate,
     Document,
     Node,
-    ChatSession
+    ChatSession,
+    ResponseCache,
+    ChunkEmbedding,
+    DocumentData,
+    IngestJob
 )
 
 # ================
@@ -248,6 +269,7 @@ def create_document_by_file_path(
     file_hash: Optional[str] = None,
     overwrite: Optional[bool] = True,
     session: Optional[Session] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
 ):
     if not organization or not project:
         raise HTTPException(
@@ -260,17 +282,24 @@ def create_document_by_file_path(
     if not file_path or not os.path.exists(file_path):
         raise HTTPException(status_code=400, detail="A valid file path is required")
 
-    if not file_hash:
-        file_hash = get_file_hash(file_path)
-
     file_name = os.path.basename(file_path)
 
-    file_contents = open(file_path, "rb").read()
+    with open(file_path, "rb") as f:
+        file_contents = f.read()
+
+    # Uploads hash while streaming to disk and pass the digest along
+    if not file_hash:
+        file_hash = get_sha256(file_contents)
 
     # ------------------------
     # Handle duplicate content
     # ------------------------
-    if get_document_by_hash(file_hash, session=session):
+    duplicate = get_document_by_hash(file_hash, session=session)
+    if duplicate and duplicate.node_count == 0:
+        # Left behind by an ingest that died before this was one transaction, resume it
+        logger.warning(f"♻️  Replacing document {duplicate.uuid} left without nodes")
+        delete_document(duplicate, session=session)
+    elif duplicate:
         raise HTTPException(
             status_code=409,
             detail=f'Document "{file_name}" already uploaded! \n\nsha256:{file_hash}!',
@@ -280,66 +309,159 @@ def create_document_by_file_path(
     # Handle file versioning by filename
     # ----------------------------------
 
-    # If we are overwriting, deprecate the current version and increment the version number of new file
-    document = get_document_by_name(
+    # If we are overwriting, increment the version number of new file. The current
+    # version is deprecated once the new one is ingested
+    previous_document = get_document_by_name(
         file_name,
         project_id=project_id,
         organization_id=organization_id,
         session=session,
     )
 
-    if document and overwrite:
-        file_version = document.version + 1
-        document.updated_at = datetime.utcnow()
-        document.status = ENTITY_STATUS.DEPRECATED.value
-        document.save()
+    if previous_document and overwrite:
+        file_version = previous_document.version + 1
     else:
-        # ---------------------
-        # Create a new document
-        # ---------------------
-        document = Document(
-            display_name=file_name,
-            project_id=project.id,
-            organization_id=organization.id,
+        previous_document = None
+
+    # ---------------------
+    # Create a new document
+    # ---------------------
+    document = Document(
+        display_name=file_name,
+        project_id=project.id,
+        organization_id=organization.id,
+        version=file_version,
+        hash=file_hash,
+        url=url if url else None,
+    )
+    if session:
+        create_document_with_nodes(
+            document,
             data=file_contents,
-            version=file_version,
-            hash=file_hash,
-            url=url if url else None,
+            project=project,
+            organization=organization,
+            previous_document=previous_document,
+            session=session,
+            on_progress=on_progress,
         )
-        if session:
-            session.add(document)
-            session.commit()
-            session.refresh(document)
-
-            # ---------------------
-            # Create the embeddings
-            # ---------------------
-            create_document_nodes(
-                document=document,
+    else:
+        with Session(get_engine()) as session:
+            create_document_with_nodes(
+                document,
+                data=file_contents,
                 project=project,
                 organization=organization,
+                previous_document=previous_document,
                 session=session,
+                on_progress=on_progress,
             )
 
-        else:
-            with Session(get_engine()) as session:
-                session.add(document)
-                session.commit()
-                session.refresh(document)
-
-                # ---------------------
-                # Create the embeddings
-                # ---------------------
-                create_document_nodes(
-                    document=document,
-                    project=project,
-                    organization=organization,
-                    session=session,
-                )
-
     if not document:
         raise HTTPException(status_code=400, detail="Could not create document")
 
+    return document
+
+
+def create_document_with_nodes(
+    document: Document,
+    data: bytes,
+    project: Project,
+    organization: Organization,
+    session: Session,
+    previous_document: Optional[Document] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+):
+    # -------------------------------------------------------
+    # Flushed, not committed: the document, its file and its
+    # nodes are committed together by create_document_nodes,
+    # so nobody sees a document without nodes and a failed or
+    # killed ingest leaves nothing behind
+    # -------------------------------------------------------
+    session.add(document)
+    session.flush()
+    session.add(DocumentData(document_id=document.id, data=data, size=len(data)))
+    session.flush()
+
+    # ---------------------
+    # Create the embeddings
+    # ---------------------
+    create_document_nodes(
+        document=document,
+        project=project,
+        organization=organization,
+        data=data,
+        session=session,
+        on_progress=on_progress,
+    )
+
+    # Only retire the previous version once the new one is searchable
+    if previous_document:
+        deprecate_document(previous_document, session=session)
+
+
+def delete_document(document: Document, session: Optional[Session] = None):
+    # Its DocumentData row goes with it (ON DELETE CASCADE)
+    if session:
+        session.delete(document)
+        session.commit()
+    else:
+        with Session(get_engine()) as session:
+            session.delete(document)
+            session.commit()
+
+
+# ----------------------------------------------------------
+# Mark a project's documents as changed. Cached answers older
+# than Project.updated_at are no longer served
+# ----------------------------------------------------------
+def touch_project(project_id: int):
+    return (
+        update(Project)
+        .where(Project.id == project_id)
+        .values(updated_at=datetime.now())
+    )
+
+
+# ------------------------------------------------------
+# Deprecate a document version so it drops out of search
+# ------------------------------------------------------
+def deprecate_document(document: Document, session: Optional[Session] = None):
+    document.status = ENTITY_STATUS.DEPRECATED.value
+    document.updated_at = datetime.utcnow()
+
+    deprecate_nodes = (
+        update(Node)
+        .where(Node.document_id == document.id)
+        .values(status=ENTITY_STATUS.DEPRECATED.value, updated_at=datetime.utcnow())
+    )
+
+    # Cached LLM answers built from any of these nodes
+    delete_responses = delete(ResponseCache).where(
+        ResponseCache.node_ids.overlap(
+            select(func.array_agg(Node.id))
+            .where(Node.document_id == document.id)
+            .scalar_subquery()
+        )
+    )
+
+    if session:
+        session.add(document)
+        session.execute(deprecate_nodes)
+        session.execute(delete_responses)
+        session.execute(touch_project(document.project_id))
+        session.commit()
+        session.refresh(document)
+    else:
+        with Session(get_engine()) as session:
+            session.add(document)
+            session.execute(deprecate_nodes)
+            session.execute(delete_responses)
+            session.execute(touch_project(document.project_id))
+            session.commit()
+            session.refresh(document)
+
+    vector_store.remove_document(document.project_id, document.id)
+
 
 # --------------------------
 # Create document embeddings
@@ -348,10 +470,12 @@ def create_document_nodes(
     document: Document,
     project: Project,
     organization: Organization,
+    data: Optional[bytes] = None,
     session: Optional[Session] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
 ):
     # Avoid circular imports
-    from llm import get_embeddings, get_token_count
+    from llm import split_document, embed_documents, get_token_counts
 
     project_uuid = str(project.uuid)
     document_uuid = str(document.uuid)
@@ -371,47 +495,196 @@ def create_document_nodes(
     }
 
     # convert document data bytes to string
-    document_data = (
-        document.data.decode("utf-8")
-        if isinstance(document.data, bytes)
-        else document.data
-    )
+    if data is None:
+        data = get_document_data(document.id, session=session)
+    document_data = data.decode("utf-8") if isinstance(data, bytes) else data
 
     # lets get the embeddings
-    arr_documents, embeddings = get_embeddings(document_data)
+    arr_documents = split_document(document_data)
+    chunk_hashes = [get_sha256(doc.encode("utf-8")) for doc in arr_documents]
+    token_counts = get_token_counts(arr_documents)
+
+    # Only chunks never embedded under this model, by any document, go to the API
+    embeddings_by_hash = get_chunk_embeddings(chunk_hashes, session=session)
+    missing = {
+        chunk_hash: (doc, token_count)
+        for chunk_hash, doc, token_count in zip(chunk_hashes, arr_documents, token_counts)
+        if chunk_hash not in embeddings_by_hash
+    }
+    # Ingest runs in worker.py, whose counters /stats can't see, so log them too
+    increment("chunk_embedding.hit", len(chunk_hashes) - len(missing))
+    increment("chunk_embedding.miss", len(missing))
+    logger.info(
+        f"♻️  {document.display_name} v{document.version}: reusing "
+        f"{len(chunk_hashes) - len(missing)}/{len(chunk_hashes)} chunk embeddings"
+    )
+
+    def report_progress(done: int, total: int):
+        logger.info(f"📄 {document.display_name} v{document.version}: embedded {done}/{total} new chunks")
+        if on_progress:
+            on_progress(done, total)
+
+    missing_texts = [doc for doc, _ in missing.values()]
+    missing_token_counts = [token_count for _, token_count in missing.values()]
+    if missing:
+        missing_embeddings = embed_documents(
+            missing_texts, token_counts=missing_token_counts, on_progress=report_progress
+        )
+    else:
+        missing_embeddings = []
+        report_progress(0, 0)
+
+    new_chunks = [
+        ChunkEmbedding(
+            chunk_hash=chunk_hash,
+            model=EMBEDDING_MODEL,
+            embeddings=vec,
+            token_count=token_count,
+        )
+        for chunk_hash, vec, token_count in zip(missing, missing_embeddings, missing_token_counts)
+    ]
+    embeddings_by_hash.update({chunk.chunk_hash: chunk.embeddings for chunk in new_chunks})
 
     # -------------------------------------------
     # Process the embeddings and save to database
     # -------------------------------------------
-
-    for doc, vec in zip(arr_documents, embeddings):
-        node = Node(
+    nodes = [
+        Node(
             document_id=document.id,
-            embeddings=vec,
+            project_id=project.id,
+            organization_id=organization.id,
+            embeddings=embeddings_by_hash[chunk_hash],
             text=doc,
-            token_count=get_token_count(doc),
+            chunk_hash=chunk_hash,
+            token_count=token_count,
             meta=metadata
         )
-        if session:
-            session.add(node)
+        for doc, chunk_hash, token_count in zip(arr_documents, chunk_hashes, token_counts)
+    ]
+
+    # A document's nodes are committed together, or not at all
+    if session:
+        try:
+            insert_chunk_embeddings(new_chunks, session=session)
+            insert_nodes(nodes, session=session)
+            session.execute(touch_project(project.id))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+    else:
+        with Session(get_engine()) as session:
+            insert_chunk_embeddings(new_chunks, session=session)
+            insert_nodes(nodes, session=session)
+            session.execute(touch_project(project.id))
             session.commit()
-            session.refresh(node)
 
-        else:
-            with Session(get_engine()) as session:
-                session.add(node)
-                session.commit()
-                session.refresh(node)
+    # Keep this process's in-memory index (if loaded) in sync
+    vector_store.add_nodes(project.id, nodes)
+
+
+# -------------------------------------------------------------
+# Bulk insert nodes: one multi-row INSERT per batch instead of
+# an add/commit/refresh round trip per node. The caller commits
+# -------------------------------------------------------------
+NODE_INSERT_BATCH_SIZE = 500
+
+
+def insert_nodes(nodes: List[Node], session: Session):
+    for i in range(0, len(nodes), NODE_INSERT_BATCH_SIZE):
+        batch = nodes[i:i + NODE_INSERT_BATCH_SIZE]
+        rows = [
+            {
+                "document_id": node.document_id,
+                "project_id": node.project_id,
+                "organization_id": node.organization_id,
+                "uuid": node.uuid,
+                "embeddings": node.embeddings,
+                "meta": node.meta,
+                "token_count": node.token_count,
+                "text": node.text,
+                "chunk_hash": node.chunk_hash,
+                "status": node.status,
+                "created_at": node.created_at,
+                "updated_at": node.updated_at,
+            }
+            for node in batch
+        ]
+
+        # uuids are generated client side, so they map the new ids back
+        ids = dict(
+            session.execute(
+                insert(Node).values(rows).returning(Node.uuid, Node.id)
+            ).all()
+        )
+        for node in batch:
+            node.id = ids[node.uuid]
+
+
+# ---------------------------------
+# Get a document's raw file contents
+# ---------------------------------
+def get_document_data(document_id: int, session: Optional[Session] = None) -> bytes:
+    if session:
+        document_data = session.get(DocumentData, document_id)
+    else:
+        with Session(get_engine()) as session:
+            document_data = session.get(DocumentData, document_id)
+
+    if not document_data:
+        raise HTTPException(status_code=404, detail=f"No file stored for document {document_id}")
+
+    return document_data.data
 
-        # Node.create(
-        #     {
-        #         "document_id": document.id,
-        #         "embeddings": vec,
-        #         "text": doc,
-        #         "token_count": get_token_count(doc),
-        #         "meta": metadata,
-        #     }
-        # )
+
+# ------------------------------------------------------
+# Content addressed chunk embeddings, keyed by the sha256
+# of the chunk text and the embedding model
+# ------------------------------------------------------
+def get_chunk_embeddings(
+    chunk_hashes: List[str],
+    model: str = EMBEDDING_MODEL,
+    session: Optional[Session] = None,
+) -> Dict[str, List[float]]:
+    chunk_hashes = list(set(chunk_hashes))
+
+    def fetch(session: Session) -> Dict[str, List[float]]:
+        embeddings = {}
+        for i in range(0, len(chunk_hashes), NODE_INSERT_BATCH_SIZE):
+            embeddings.update(
+                session.exec(
+                    select(ChunkEmbedding.chunk_hash, ChunkEmbedding.embeddings).where(
+                        ChunkEmbedding.chunk_hash.in_(chunk_hashes[i:i + NODE_INSERT_BATCH_SIZE]),
+                        ChunkEmbedding.model == model,
+                    )
+                ).all()
+            )
+        return embeddings
+
+    if session:
+        return fetch(session)
+    else:
+        with Session(get_engine()) as session:
+            return fetch(session)
+
+
+def insert_chunk_embeddings(chunks: List[ChunkEmbedding], session: Session):
+    # Another ingest may have stored the same chunk meanwhile, first one wins
+    for i in range(0, len(chunks), NODE_INSERT_BATCH_SIZE):
+        session.execute(
+            pg_insert(ChunkEmbedding)
+            .values([
+                {
+                    "chunk_hash": chunk.chunk_hash,
+                    "model": chunk.model,
+                    "embeddings": chunk.embeddings,
+                    "token_count": chunk.token_count,
+                    "created_at": chunk.created_at,
+                }
+                for chunk in chunks[i:i + NODE_INSERT_BATCH_SIZE]
+            ])
+            .on_conflict_do_nothing(constraint="unq_chunk_embedding_hash_model")
+        )
 
 
 def get_documents_by_project_and_org(
@@ -520,6 +793,26 @@ def get_document_by_name(
             ).first()
 
 
+async def get_document_file_async(
+    document: Document, session: AsyncSession
+) -> Tuple[bytes, int]:
+    # Returns the still compressed file and its size, the caller streams it out
+    row = (
+        await session.execute(
+            select(type_coerce(DocumentData.data, LargeBinary), DocumentData.size).where(
+                DocumentData.document_id == document.id
+            )
+        )
+    ).first()
+
+    if not row:
+        raise HTTPException(
+            status_code=404, detail=f"No file stored for document {document.uuid}"
+        )
+
+    return row[0], row[1]
+
+
 # ---------------------
 # ChatSession functions
 # ---------------------
@@ -655,4 +948,373 @@ def get_project_by_uuid(
             status_code=404, detail=f"Project identifier {uuid} not found"
         )
 
-    return project
\ No newline at end of file
+    return project
+
+# ======================
+# Async helper functions
+# ======================
+# These mirror the helpers above for the async request path. Relationships the
+# response models touch are eager loaded, since lazy loads cannot run once the
+# AsyncSession has handed the objects back to FastAPI for serialization.
+
+
+# -------------------------------------------------------
+# Keyset pagination: rows after the cursor's id in id
+# order, so a page costs the same however deep it is and
+# concurrent inserts don't shift rows between pages
+# -------------------------------------------------------
+async def get_page_async(
+    query,
+    model,
+    session: AsyncSession,
+    limit: int = PAGE_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+) -> Tuple[List[Any], Optional[str]]:
+    limit = max(1, min(limit, PAGE_MAX_LIMIT))
+    after_id = decode_cursor(cursor)
+    if after_id is not None:
+        query = query.where(model.id > after_id)
+
+    # One extra row tells us whether there is a next page
+    rows = (await session.exec(query.order_by(model.id).limit(limit + 1))).all()
+    next_cursor = encode_cursor(rows[limit - 1].id) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+# ----------------------
+# Organization functions
+# ----------------------
+async def get_org_by_uuid_or_namespace_async(
+    id: Union[UUID, str], session: AsyncSession, should_except: bool = True
+):
+    q = (
+        select(Organization).where(Organization.uuid == str(id))
+        if is_uuid(str(id))
+        else select(Organization).where(Organization.namespace == str(id))
+    )
+    org = (await session.exec(q)).first()
+
+    if not org and should_except is True:
+        raise HTTPException(
+            status_code=404, detail=f"Organization identifer {id} not found"
+        )
+
+    return org
+
+
+async def get_orgs_async(
+    session: AsyncSession,
+    limit: int = PAGE_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+):
+    return await get_page_async(
+        select(Organization).where(Organization.status == ENTITY_STATUS.ACTIVE.value),
+        Organization,
+        limit=limit,
+        cursor=cursor,
+        session=session,
+    )
+
+
+# --------------
+# User functions
+# --------------
+async def get_users_async(
+    session: AsyncSession,
+    limit: int = PAGE_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+):
+    # chat_session_count is a COUNT subquery, the sessions themselves aren't loaded
+    return await get_page_async(
+        select(User), User, limit=limit, cursor=cursor, session=session
+    )
+
+
+async def get_user_by_uuid_or_identifier_async(
+    id: Union[UUID, str],
+    session: AsyncSession,
+    should_except: bool = True,
+    load_chat_sessions: bool = False,
+):
+    q = (
+        select(User).where(User.uuid == str(id))
+        if is_uuid(str(id))
+        else select(User).where(User.identifier == str(id))
+    )
+
+    # Only GET /user/{id} returns the history, the chat path just needs the row
+    if load_chat_sessions:
+        q = q.options(
+            selectinload(User.chat_sessions).selectinload(ChatSession.project)
+        )
+
+    user = (await session.exec(q)).first()
+
+    if not user and should_except is True:
+        raise HTTPException(status_code=404, detail=f"User identifer {id} not found")
+
+    return user
+
+
+async def create_user_async(user_params: dict, session: AsyncSession):
+    db_user = User(**user_params)
+    session.add(db_user)
+    await session.commit()
+    await session.refresh(db_user)
+    return db_user
+
+
+# ------------------
+# Document functions
+# ------------------
+async def get_documents_by_project_and_org_async(
+    project_id: Union[UUID, str],
+    organization_id: Union[UUID, str],
+    session: AsyncSession,
+    limit: int = PAGE_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+    load_nodes: bool = True,
+):
+    project = await get_project_by_uuid_async(
+        project_id, organization_id=organization_id, session=session, load_documents=False
+    )
+    # Only the node columns DocumentReadList shows, embeddings and text stay behind
+    nodes = (
+        selectinload(Document.nodes).load_only(
+            Node.id, Node.uuid, Node.document_id, Node.token_count, Node.created_at
+        )
+        if load_nodes
+        else noload(Document.nodes)
+    )
+    return await get_page_async(
+        select(Document)
+        .where(Document.project_id == project.id)
+        .options(nodes),
+        Document,
+        limit=limit,
+        cursor=cursor,
+        session=session,
+    )
+
+
+async def get_document_by_uuid_async(
+    uuid: Union[UUID, str],
+    organization_id: Union[UUID, str],
+    project_id: Union[UUID, str],
+    session: AsyncSession,
+    should_except: bool = True,
+):
+    if not is_uuid(uuid):
+        raise HTTPException(
+            status_code=422, detail=f"Invalid document identifier {uuid}"
+        )
+
+    project = await get_project_by_uuid_async(
+        project_id, organization_id=organization_id, session=session, load_documents=False
+    )
+    document = (
+        await session.exec(
+            select(Document)
+            .where(Document.project_id == project.id, Document.uuid == str(uuid))
+            .options(
+                selectinload(Document.organization),
+                selectinload(Document.project),
+            )
+        )
+    ).first()
+
+    if not document and should_except is True:
+        raise HTTPException(
+            status_code=404, detail=f"Document identifier {uuid} not found"
+        )
+
+    return document
+
+
+async def get_document_by_hash_async(hash: str, session: AsyncSession):
+    # A document without nodes is an interrupted ingest, the worker replaces it
+    return (
+        await session.exec(
+            select(Document.id).where(Document.hash == hash, Document.node_count > 0)
+        )
+    ).first()
+
+
+# ---------------------
+# ChatSession functions
+# ---------------------
+async def get_chat_session_by_uuid_async(
+    id: Union[UUID, str], session: AsyncSession, should_except: bool = False
+):
+    chat_session = (
+        await session.exec(
+            select(ChatSession).where(ChatSession.session_id == str(id))
+        )
+    ).first()
+
+    if not chat_session and should_except is True:
+        raise HTTPException(
+            status_code=404, detail=f"ChatSession identifer {id} not found"
+        )
+
+    return chat_session
+
+
+# -----------------
+# Project functions
+# -----------------
+async def get_projects_by_org_async(
+    organization_id: Union[UUID, str],
+    session: AsyncSession,
+    limit: int = PAGE_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+    load_documents: bool = True,
+):
+    org = await get_org_by_uuid_or_namespace_async(organization_id, session=session)
+    return await get_page_async(
+        select(Project)
+        .where(Project.organization_id == org.id)
+        .options(selectinload(Project.documents) if load_documents else noload(Project.documents)),
+        Project,
+        limit=limit,
+        cursor=cursor,
+        session=session,
+    )
+
+
+async def get_project_by_uuid_async(
+    uuid: Union[UUID, str],
+    organization_id: Union[UUID, str],
+    session: AsyncSession,
+    should_except: bool = True,
+    load_documents: bool = True,
+):
+    if not is_uuid(uuid):
+        raise HTTPException(
+            status_code=422, detail=f"Invalid project identifier {uuid}"
+        )
+
+    org = await get_org_by_uuid_or_namespace_async(organization_id, session=session)
+    options = [selectinload(Project.organization)]
+    if load_documents:
+        options.append(selectinload(Project.documents))
+
+    project = (
+        await session.exec(
+            select(Project)
+            .where(Project.organization_id == org.id, Project.uuid == str(uuid))
+            .options(*options)
+        )
+    ).first()
+
+    if not project and should_except is True:
+        raise HTTPException(
+            status_code=404, detail=f"Project identifier {uuid} not found"
+        )
+
+    return project
+
+
+# -------------------
+# Ingest job functions
+# -------------------
+def create_ingest_job(
+    organization: Organization,
+    project: Project,
+    file_path: str,
+    file_hash: Optional[str] = None,
+    url: Optional[str] = None,
+    overwrite: Optional[bool] = True,
+    session: Optional[Session] = None,
+) -> IngestJob:
+    job = IngestJob(
+        organization_id=organization.id,
+        project_id=project.id,
+        file_path=file_path,
+        file_hash=file_hash,
+        url=url,
+        overwrite=overwrite,
+    )
+
+    if session:
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+    else:
+        with Session(get_engine()) as session:
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+
+    return job
+
+
+async def create_ingest_job_async(
+    organization: Organization,
+    project: Project,
+    file_path: str,
+    session: AsyncSession,
+    file_hash: Optional[str] = None,
+    url: Optional[str] = None,
+    overwrite: Optional[bool] = True,
+) -> IngestJob:
+    job = IngestJob(
+        organization_id=organization.id,
+        project_id=project.id,
+        file_path=file_path,
+        file_hash=file_hash,
+        url=url,
+        overwrite=overwrite,
+    )
+
+    session.add(job)
+    await session.commit()
+    await session.refresh(job)
+    return job
+
+
+async def get_ingest_job_by_uuid_async(
+    uuid: Union[UUID, str], session: AsyncSession, should_except: bool = True
+):
+    if not is_uuid(uuid):
+        raise HTTPException(status_code=422, detail=f"Invalid job identifier {uuid}")
+
+    job = (
+        await session.exec(
+            select(IngestJob)
+            .where(IngestJob.uuid == str(uuid))
+            .options(selectinload(IngestJob.document))
+        )
+    ).first()
+
+    if not job and should_except is True:
+        raise HTTPException(status_code=404, detail=f"Ingest job {uuid} not found")
+
+    return job
+
+
+async def retry_ingest_job_async(job: IngestJob, session: AsyncSession):
+    if job.status != JOB_STATUS.FAILED.value:
+        raise HTTPException(
+            status_code=409, detail=f"Only failed jobs can be retried, job is {JOB_STATUS(job.status).name}"
+        )
+
+    # Uploads are removed once a job fails for good
+    if not os.path.isfile(job.file_path):
+        raise HTTPException(
+            status_code=410, detail=f"The upload for job {job.uuid} is gone, upload the file again"
+        )
+
+    job.status = JOB_STATUS.QUEUED.value
+    job.attempts = 0
+    job.error = None
+    job.progress_done = 0
+    job.progress_total = None
+    job.finished_at = None
+    job.run_after = datetime.now()
+    job.updated_at = datetime.now()
+
+    # No refresh: it would expire the eagerly loaded document relationship
+    session.add(job)
+    await session.commit()
+    return job
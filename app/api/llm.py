@@ -1,25 +1,52 @@
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
+import tiktoken
 import random
-import openai
+import time
 import json
 
 from langchain.docstore.document import Document as LangChainDocument
-from langchain.embeddings.openai import OpenAIEmbeddings
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.orm import selectinload
 from fastapi import HTTPException
 from uuid import UUID, uuid4
 from langchain.text_splitter import (
     CharacterTextSplitter,
     MarkdownTextSplitter
 )
+from sqlalchemy import (
+    bindparam,
+    Float,
+    Integer
+)
 from sqlmodel import (
     Session,
+    select,
     text
 )
 from util import (
+    JSONStringFieldParser,
     sanitize_input,
     sanitize_output
 )
-from langchain import OpenAI
+from cache import (
+    LRUCache,
+    normalize_query,
+    get_cache_key
+)
+from metrics import increment, observe
+from concurrency import MicroBatcher, SingleFlight
+from openai_client import (
+    CircuitOpenError,
+    OpenAIError,
+    get_openai_client
+)
 from typing import (
+    AsyncIterator,
+    Callable,
     List,
     Union,
     Optional,
@@ -28,17 +55,26 @@ from typing import (
     Any
 )
 from helpers import (
-    get_user_by_uuid_or_identifier,
-    get_chat_session_by_uuid
+    get_user_by_uuid_or_identifier_async,
+    get_chat_session_by_uuid_async,
+    create_user_async
+)
+from vector_store import (
+    is_memory_indexed,
+    get_project_index,
+    get_project_index_async
 )
 from models import (
-    User,
     Organization,
     Project,
-    Node,
     ChatSession,
     ChatSessionResponse,
-    get_engine
+    NodeReadResult,
+    EmbeddingCache,
+    ResponseCache,
+    Vector,
+    get_engine,
+    get_async_engine
 )
 from config import (
     CHANNEL_TYPE,
@@ -51,6 +87,21 @@ from config import (
     LLM_CHUNK_OVERLAP,
     LLM_MIN_NODE_LIMIT,
     LLM_DEFAULT_DISTANCE_STRATEGY,
+    EMBEDDING_MODEL,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_MAX_TOKENS,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_QUERY_BATCH_SIZE,
+    EMBEDDING_QUERY_BATCH_WAIT_MS,
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_PERSIST,
+    EMBEDDING_CACHE_SIZE,
+    LLM_SEMANTIC_CACHE_ENABLED,
+    LLM_SEMANTIC_CACHE_THRESHOLD,
+    LLM_SEMANTIC_CACHE_TTL,
+    LLM_RESPONSE_CACHE_ENABLED,
+    LLM_RESPONSE_CACHE_SIZE,
+    LLM_COALESCE_ENABLED,
     VECTOR_EMBEDDINGS_COUNT,
     DISTANCE_STRATEGY,
     AGENT_NAMES,
@@ -58,24 +109,57 @@ from config import (
 )
 
 
+# ----------------------------------------------------------
+# State carried between the stages of a chat query, so the
+# blocking and streaming endpoints share everything but the
+# LLM call itself
+# ----------------------------------------------------------
+@dataclass
+class ChatQuery:
+    query_str: str
+    query_embeddings: List[float]
+    nodes: List[NodeReadResult]
+    session_id: Optional[str] = None
+    meta: Dict[str, Any] = field(default_factory=dict)
+    project: Optional[Project] = None
+    organization: Optional[Organization] = None
+    model: Optional[LLM_MODELS] = LLM_MODELS.GPT_35_TURBO
+    temperature: float = LLM_DEFAULT_TEMPERATURE
+    max_output_tokens: int = LLM_MAX_OUTPUT_TOKENS
+    response_cache_key: Optional[str] = None
+    system_prompt: Optional[List[dict]] = None
+    user_prompt: Optional[str] = None
+    prompt_token_count: int = 0
+    response_message: Optional[str] = None
+    tags: List[str] = field(default_factory=list)
+    is_escalate: bool = False
+
+    @property
+    def needs_llm(self) -> bool:
+        return self.user_prompt is not None
+
+
 # -------------
 # Query the LLM
 # -------------
-def chat_query(
+async def chat_query(
     query_str: str,
+    session: AsyncSession,
     session_id: Optional[Union[str, UUID]] = None,
     meta: Optional[Dict[str, Any]] = {},
     channel: Optional[CHANNEL_TYPE] = None,
     identifier: Optional[str] = None,
     project: Optional[Project] = None,
     organization: Optional[Organization] = None,
-    session: Optional[Session] = None,
     user_data: Optional[Dict[str, Any]] = None,
     distance_strategy: Optional[DISTANCE_STRATEGY] = DISTANCE_STRATEGY.EUCLIDEAN,
     distance_threshold: Optional[float] = LLM_DISTANCE_THRESHOLD,
     node_limit: Optional[int] = LLM_MIN_NODE_LIMIT,
     model: Optional[LLM_MODELS] = LLM_MODELS.GPT_35_TURBO,
     max_output_tokens: Optional[int] = LLM_MAX_OUTPUT_TOKENS,
+    probes: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    temperature: Optional[float] = LLM_DEFAULT_TEMPERATURE,
 ) -> ChatSessionResponse:
     """
     Steps:
@@ -85,36 +169,97 @@ def chat_query(
         4. ✅ Create prompt template w/ similar nodes
         5. ✅ Submit prompt template to LLM
         6. ✅ Get response from LLM
-        7. Create ChatSession
+        7. ✅ Create ChatSession
             - Store embeddings
             - Store tags
             - Store is_escalate
-        8. Return response
+        8. ✅ Return response
     """
-    meta = {}
-    agent_name = None
-    embeddings = []
-    tags = []
-    is_escalate = False
-    response_message = None
-    prompt = None
-    context_str = None
-    MODEL_TOKEN_LIMIT = (
-        model.token_limit if isinstance(model, OpenAI) else LLM_MAX_OUTPUT_TOKENS
+    session_id, agent_name = await get_chat_session_agent(session_id, session=session)
+
+    # Hand the connection back to the pool while the answer is worked out, the
+    # session picks up a fresh one to save the ChatSession row
+    await session.commit()
+
+    params = {
+        "project": project,
+        "organization": organization,
+        "distance_strategy": distance_strategy,
+        "distance_threshold": distance_threshold,
+        "node_limit": node_limit,
+        "model": model,
+        "max_output_tokens": max_output_tokens,
+        "probes": probes,
+        "ef_search": ef_search,
+        "temperature": temperature,
+    }
+
+    if LLM_COALESCE_ENABLED:
+        # ------------------------------------------------------
+        # Identical questions in flight together share one answer
+        # ------------------------------------------------------
+        flight_key = get_cache_key(
+            project.id if project else None,
+            organization.id if organization else None,
+            normalize_query(sanitize_input(query_str)),
+            get_model_name(model),
+            temperature,
+            distance_strategy,
+            distance_threshold,
+            node_limit,
+            max_output_tokens,
+            probes,
+            ef_search,
+            # The agent persona is part of the prompt, so it shapes the answer
+            agent_name,
+        )
+        chat, shared = await chat_flights.do(
+            flight_key,
+            lambda: answer_chat_query_in_own_session(
+                query_str, agent_name=agent_name, **params
+            ),
+        )
+        # Every caller gets its own copy to attach its session to
+        chat = replace(chat, meta=dict(chat.meta), tags=list(chat.tags))
+        if shared:
+            chat.meta["coalesced"] = True
+    else:
+        chat = await answer_chat_query(
+            query_str, session=session, agent_name=agent_name, **params
+        )
+
+    chat.session_id = session_id
+    chat.meta["agent"] = agent_name if agent_name else random.choice(AGENT_NAMES)
+
+    return await save_chat_session(
+        chat,
+        session=session,
+        channel=channel,
+        identifier=identifier,
+        user_data=user_data,
     )
 
+
+# ---------------------------------------------------------
+# Per caller: validate session_id, or start a new session
+# ---------------------------------------------------------
+async def get_chat_session_agent(
+    session_id: Optional[Union[str, UUID]], session: AsyncSession
+) -> Tuple[str, Optional[str]]:
+    agent_name = None
+
     # ---------------------------------------------
     # Generate a new session ID if none is provided
     # ---------------------------------------------
     prev_chat_session = (
-        get_chat_session_by_uuid(session_id=session_id, session=session)
+        await get_chat_session_by_uuid_async(session_id, session=session)
         if session_id
         else None
     )
 
     # If we were given an invalid session_id
     if session_id and not prev_chat_session:
-        return HTTPException(
+        raise HTTPException(
             status_code=404, detail=f"Chat session with ID {session_id} not found."
         )
     # If we were given a valid session_id
@@ -124,7 +269,47 @@ def chat_query(
     else:
         session_id = str(uuid4())
 
-    meta["agent"] = agent_name if agent_name else random.choice(AGENT_NAMES)
+    return str(session_id), agent_name
+
+
+# ---------------------------------------------------------
+# Stage 1: everything up to the LLM call. Cache hits and
+# queries without context come back with a response already
+# ---------------------------------------------------------
+async def prepare_chat_query(
+    query_str: str,
+    session: AsyncSession,
+    session_id: Optional[Union[str, UUID]] = None,
+    **params,
+) -> ChatQuery:
+    session_id, agent_name = await get_chat_session_agent(session_id, session=session)
+    chat = await retrieve_chat_context(
+        query_str, session=session, agent_name=agent_name, **params
+    )
+    chat.session_id = session_id
+    chat.meta["agent"] = agent_name if agent_name else random.choice(AGENT_NAMES)
+
+    # The caller streams the LLM answer next, release the connection meanwhile
+    await session.commit()
+    return chat
+
+
+async def retrieve_chat_context(
+    query_str: str,
+    session: AsyncSession,
+    agent_name: Optional[str] = None,
+    project: Optional[Project] = None,
+    organization: Optional[Organization] = None,
+    distance_strategy: Optional[DISTANCE_STRATEGY] = DISTANCE_STRATEGY.EUCLIDEAN,
+    distance_threshold: Optional[float] = LLM_DISTANCE_THRESHOLD,
+    node_limit: Optional[int] = LLM_MIN_NODE_LIMIT,
+    model: Optional[LLM_MODELS] = LLM_MODELS.GPT_35_TURBO,
+    max_output_tokens: Optional[int] = LLM_MAX_OUTPUT_TOKENS,
+    probes: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    temperature: Optional[float] = LLM_DEFAULT_TEMPERATURE,
+) -> ChatQuery:
+    meta = {}
 
     # ----------------
     # Clean user input
@@ -132,95 +317,194 @@ def chat_query(
     query_str = sanitize_input(query_str)
     logger.debug(f"💬 Query received: {query_str}")
 
-    # ----------------
-    # Get token counts
-    # ----------------
-    query_token_count = get_token_count(query_str)
-    prompt_token_count = 0
-
     # -----------------------
     # Create input embeddings
     # -----------------------
-    arr_query, embeddings = get_embeddings(query_str)
-
-    query_embeddings = embeddings[0]
+    query_embeddings = await get_query_embeddings(query_str, session=session)
 
     # ------------------------
     # Search for similar nodes
     # ------------------------
-    nodes = get_nodes_by_embedding(
+    nodes = await get_nodes_by_embedding_async(
         query_embeddings,
         node_limit,
         distance_strategy=distance_strategy
         if isinstance(distance_strategy, DISTANCE_STRATEGY)
         else LLM_DEFAULT_DISTANCE_STRATEGY,
         distance_threshold=distance_threshold,
+        project_id=project.id if project else None,
+        organization_id=organization.id if organization else None,
+        probes=probes,
+        ef_search=ef_search,
         session=session,
     )
 
-    if len(nodes) > 0:
-        if (not project or not organization) and session:
-            # get document from Node via session object:
-            document = session.get(Node, nodes[0].id).document
-            project = document.project
-            organization = project.organization
+    if len(nodes) > 0 and (not project or not organization):
+        project = (
+            await session.exec(
+                select(Project)
+                .where(Project.id == nodes[0].project_id)
+                .options(selectinload(Project.organization))
+            )
+        ).first()
+        organization = project.organization
 
-        # ----------------------
-        # Create prompt template
-        # ----------------------
+    chat = ChatQuery(
+        query_str=query_str,
+        meta=meta,
+        query_embeddings=query_embeddings,
+        nodes=nodes,
+        project=project,
+        organization=organization,
+        model=model,
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+    )
 
-        # concatenate all nodes into a single string
-        context_str = "\n\n".join([node.text for node in nodes])
+    # ------------------------------------------------------
+    # Reuse the answer to the same query over the same nodes
+    # ------------------------------------------------------
+    chat.response_cache_key = (
+        get_response_cache_key(query_str, nodes, model, temperature)
+        if LLM_RESPONSE_CACHE_ENABLED and len(nodes) > 0
+        else None
+    )
+    cached_response = (
+        await get_response_cache_hit_async(chat.response_cache_key, session=session)
+        if chat.response_cache_key
+        else None
+    )
 
-        # -------------------------------------------
-        # Let's make sure we don't exceed token limit
-        # -------------------------------------------
-        context_token_count = get_token_count(context_str)
+    # -----------------------------------------------
+    # Reuse a recent answer to a near-identical query
+    # -----------------------------------------------
+    cached_chat_session = (
+        await get_semantic_cache_hit_async(project, query_embeddings, session=session)
+        if LLM_SEMANTIC_CACHE_ENABLED and project and len(nodes) > 0 and not cached_response
+        else None
+    )
 
+    if cached_response:
+        logger.debug(f"♻️  Response cache hit: {chat.response_cache_key}")
+        chat.tags = cached_response.get("tags", [])
+        chat.is_escalate = cached_response.get("is_escalate", False)
+        chat.response_message = cached_response.get("message", None)
+        meta["cache"] = "exact"
+    elif cached_chat_session:
+        logger.debug(f"♻️  Semantic cache hit: {cached_chat_session}")
+        chat.tags = cached_chat_session.meta.get("tags", [])
+        chat.is_escalate = cached_chat_session.meta.get("is_escalate", False)
+        chat.response_message = cached_chat_session.response
+        meta["cache"] = "semantic"
+        meta["cache_source_id"] = cached_chat_session.id
+    elif len(nodes) > 0:
         # ----------------------------------------------
-        # if token count exceeds limit, truncate context
+        # Create prompt template from the nodes that fit
         # ----------------------------------------------
-        if (
-            context_token_count + query_token_count + prompt_token_count
-        ) > MODEL_TOKEN_LIMIT:
-            logger.debug("🚧 Exceeded token limit, truncating context")
-            token_delta = MODEL_TOKEN_LIMIT - (query_token_count + prompt_token_count)
-            context_str = context_str[:token_delta]
-
-        # create prompt template
-        system_prompt, user_prompt = get_prompt_template(
-            user_query=query_str,
-            context_str=context_str,
+        (
+            chat.system_prompt,
+            chat.user_prompt,
+            chat.prompt_token_count,
+        ) = get_packed_prompt(
+            query_str,
+            nodes,
             project=project,
             organization=organization,
             agent=agent_name,
+            model=model,
+            max_output_tokens=max_output_tokens,
+        )
+    else:
+        logger.info("🚫📝 No similar nodes found, returning default response")
+
+    return chat
+
+
+# -------------------------------------------
+# Stage 2: record the LLM's parsed JSON answer
+# -------------------------------------------
+async def set_chat_response(
+    chat: ChatQuery, llm_response: Dict[str, Any], session: AsyncSession
+):
+    chat.tags = llm_response.get("tags", [])
+    chat.is_escalate = llm_response.get("is_escalate", False)
+    chat.response_message = llm_response.get("message", None)
+
+    if chat.response_cache_key:
+        await set_response_cache_async(
+            chat.response_cache_key,
+            chat.nodes,
+            chat.model,
+            chat.temperature,
+            {
+                "message": chat.response_message,
+                "tags": chat.tags,
+                "is_escalate": chat.is_escalate,
+            },
+            session=session,
         )
 
-        prompt_token_count = get_token_count(prompt)
-        token_count = context_token_count + query_token_count + prompt_token_count
+
+# -----------------------------------------------------------
+# Stages 1 and 2 together: the part of a chat query that only
+# depends on the question, so concurrent callers can share it
+# -----------------------------------------------------------
+chat_flights = SingleFlight("chat_flight")
+
+
+async def answer_chat_query(
+    query_str: str, session: AsyncSession, agent_name: Optional[str] = None, **params
+) -> ChatQuery:
+    chat = await retrieve_chat_context(
+        query_str, session=session, agent_name=agent_name, **params
+    )
+
+    if chat.needs_llm:
+        # Don't hold a pooled connection (or a transaction) open across the LLM call
+        await session.commit()
 
         # ---------------------------
         # Get response from LLM model
         # ---------------------------
         # It should return a JSON dict
         llm_response = json.loads(
-            retrieve_llm_response(
-                user_prompt,
-                model=model,
-                max_output_tokens=max_output_tokens,
-                prefix_messages=system_prompt,
+            await retrieve_llm_response(
+                chat.user_prompt,
+                model=chat.model,
+                temperature=chat.temperature,
+                max_output_tokens=chat.max_output_tokens,
+                prefix_messages=chat.system_prompt,
             )
         )
-        tags = llm_response.get("tags", [])
-        is_escalate = llm_response.get("is_escalate", False)
-        response_message = llm_response.get("message", None)
-    else:
-        logger.info("🚫📝 No similar nodes found, returning default response")
+        await set_chat_response(chat, llm_response, session=session)
+
+    return chat
+
+
+async def answer_chat_query_in_own_session(
+    query_str: str, agent_name: Optional[str] = None, **params
+) -> ChatQuery:
+    # A shared flight outlives any one caller, so it can't borrow a request's session
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+        return await answer_chat_query(
+            query_str, session=session, agent_name=agent_name, **params
+        )
 
+
+# ------------------------------------
+# Stage 3: persist the ChatSession row
+# ------------------------------------
+async def save_chat_session(
+    chat: ChatQuery,
+    session: AsyncSession,
+    channel: Optional[CHANNEL_TYPE] = None,
+    identifier: Optional[str] = None,
+    user_data: Optional[Dict[str, Any]] = None,
+) -> ChatSession:
     # ----------------
     # Get user details
     # ----------------
-    user = get_user_by_uuid_or_identifier(
+    user = await get_user_by_uuid_or_identifier_async(
         identifier, session=session, should_except=False
     )
 
@@ -235,48 +519,44 @@ def chat_query(
         if user_data:
             user_params = {**user_params, **user_data}
 
-        user = User.create(user_params)
+        user = await create_user_async(user_params, session=session)
     else:
         logger.debug(f"👤 User found: {user}")
 
     # -----------------------------------
     # Calculate input and response tokens
     # -----------------------------------
-    token_count = get_token_count(prompt) + get_token_count(response_message)
+    token_count = chat.prompt_token_count + get_token_count(
+        chat.response_message, model=chat.model
+    )
 
     # ---------------
     # Add to meta tag
     # ---------------
-    if tags:
-        meta["tags"] = tags
+    meta = dict(chat.meta)
+    if chat.tags:
+        meta["tags"] = chat.tags
 
-    meta["is_escalate"] = is_escalate
+    meta["is_escalate"] = chat.is_escalate
 
-    if session_id:
-        meta["session_id"] = session_id
+    if chat.session_id:
+        meta["session_id"] = chat.session_id
 
     chat_session = ChatSession(
         user_id=user.id,
-        session_id=session_id,
-        project_id=project.id if project else None,
+        session_id=chat.session_id,
+        project_id=chat.project.id if chat.project else None,
         channel=channel.value if isinstance(channel, CHANNEL_TYPE) else channel,
-        user_message=query_str,
-        embeddings=query_embeddings,
+        user_message=chat.query_str,
+        embeddings=chat.query_embeddings,
         token_count=token_count if token_count > 0 else None,
-        response=response_message,
+        response=chat.response_message,
         meta=meta,
     )
 
-    if session:
-        session.add(chat_session)
-        session.commit()
-        session.refresh(chat_session)
-
-    else:
-        with Session(get_engine()) as session:
-            session.add(chat_session)
-            session.commit()
-            session.refresh(chat_session)
+    session.add(chat_session)
+    await session.commit()
+    await session.refresh(chat_session)
 
     return chat_session
 
@@ -339,30 +619,136 @@ I will answer the user's questions using only the [DOCUMENT] provided. I will ab
     return (system_prompt, f"[USER]:\n{user_query}")
 
 
+# ----------------------------------------------------------
+# Pack whole nodes, best first, into the model's token budget
+# ----------------------------------------------------------
+CONTEXT_SEPARATOR = "\n\n"
+
+# Chat format framing per the OpenAI cookbook: every message
+# costs ~4 tokens on top of its content, the reply primer 3
+MESSAGE_TOKEN_OVERHEAD = 4
+REPLY_TOKEN_OVERHEAD = 3
+
+
+def get_model_token_limit(model: Optional[LLM_MODELS]) -> int:
+    return (
+        model.token_limit
+        if isinstance(model, LLM_MODELS)
+        else LLM_MODELS.GPT_35_TURBO.token_limit
+    )
+
+
+def get_messages_token_count(
+    messages: List[Dict[str, str]], model: Optional[LLM_MODELS] = LLM_MODELS.GPT_35_TURBO
+) -> int:
+    counts = get_token_counts([message["content"] for message in messages], model=model)
+    return sum(counts) + MESSAGE_TOKEN_OVERHEAD * len(messages) + REPLY_TOKEN_OVERHEAD
+
+
+def pack_context_nodes(
+    nodes: List[NodeReadResult],
+    token_budget: int,
+    model: Optional[LLM_MODELS] = LLM_MODELS.GPT_35_TURBO,
+) -> Tuple[List[NodeReadResult], int]:
+    # Nodes arrive in score order; take each one that still fits whole.
+    # Node.token_count is computed at ingest, only legacy rows are counted here
+    separator_token_count = get_token_count(CONTEXT_SEPARATOR, model=model)
+    packed = []
+    packed_token_count = 0
+
+    for node in nodes:
+        node_token_count = (
+            node.token_count
+            if node.token_count is not None
+            else get_token_count(node.text, model=model)
+        )
+        cost = node_token_count + (separator_token_count if packed else 0)
+        if packed_token_count + cost > token_budget:
+            continue
+        packed.append(node)
+        packed_token_count += cost
+
+    return packed, packed_token_count
+
+
+def get_packed_prompt(
+    query_str: str,
+    nodes: List[NodeReadResult],
+    project: Optional[Project] = None,
+    organization: Optional[Organization] = None,
+    agent: str = None,
+    model: Optional[LLM_MODELS] = LLM_MODELS.GPT_35_TURBO,
+    max_output_tokens: Optional[int] = LLM_MAX_OUTPUT_TOKENS,
+) -> Tuple[List[dict], str, int]:
+    # The template without any context is what every prompt pays up front
+    system_prompt, user_prompt = get_prompt_template(
+        user_query=query_str,
+        context_str=" ",
+        project=project,
+        organization=organization,
+        agent=agent,
+    )
+    template_token_count = get_messages_token_count(
+        system_prompt + [{"role": "user", "content": user_prompt}], model=model
+    )
+    token_budget = get_model_token_limit(model) - max_output_tokens - template_token_count
+
+    context_nodes, context_token_count = pack_context_nodes(nodes, token_budget, model)
+    if not context_nodes:
+        raise HTTPException(
+            status_code=413, detail="Query is too long for the model's context window."
+        )
+
+    if len(context_nodes) < len(nodes):
+        logger.debug(f"🚧 Token budget fits {len(context_nodes)} of {len(nodes)} nodes")
+
+    system_prompt, user_prompt = get_prompt_template(
+        user_query=query_str,
+        context_str=CONTEXT_SEPARATOR.join(node.text for node in context_nodes),
+        project=project,
+        organization=organization,
+        agent=agent,
+    )
+
+    return system_prompt, user_prompt, template_token_count + context_token_count
+
+
 # ----------------------------
 # Get the count of tokens used
 # ----------------------------
 # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def get_token_count(text: str):
+@lru_cache(maxsize=None)
+def get_encoding(model: LLM_MODELS = LLM_MODELS.GPT_35_TURBO) -> tiktoken.Encoding:
+    # Loading a BPE is expensive, so each model's encoding is built once per process
+    try:
+        return tiktoken.encoding_for_model(get_model_name(model))
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def get_token_count(text: str, model: LLM_MODELS = LLM_MODELS.GPT_35_TURBO) -> int:
     if not text:
         return 0
 
-    return OpenAI().get_num_tokens(text=text)
+    # User text may contain "<|endoftext|>" etc, count it as plain text
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def get_token_counts(
+    texts: List[str], model: LLM_MODELS = LLM_MODELS.GPT_35_TURBO
+) -> List[int]:
+    # One call for many strings, tiktoken encodes the batch across threads
+    encoded = get_encoding(model).encode_batch(
+        [text or "" for text in texts], disallowed_special=()
+    )
+    return [len(tokens) for tokens in encoded]
 
 
 # --------------------------------------------
 # Query embedding search for similar documents
 # --------------------------------------------
-def get_nodes_by_embedding(
-    embeddings: List[float],
-    k: int = LLM_MIN_NODE_LIMIT,
-    distance_strategy: Optional[DISTANCE_STRATEGY] = LLM_DEFAULT_DISTANCE_STRATEGY,
-    distance_threshold: Optional[float] = LLM_DISTANCE_THRESHOLD,
-    session: Optional[Session] = None,
-) -> List[Node]:
-    # Convert embeddings array into sql string
-    embeddings_str = str(embeddings)
-
+@lru_cache(maxsize=None)
+def get_match_nodes_query(distance_strategy: DISTANCE_STRATEGY):
     if distance_strategy == DISTANCE_STRATEGY.EUCLIDEAN:
         distance_fn = "match_node_euclidean"
     elif distance_strategy == DISTANCE_STRATEGY.COSINE:
@@ -372,60 +758,275 @@ def get_nodes_by_embedding(
     else:
         raise Exception(f"Invalid distance strategy {distance_strategy}")
 
+    # The SQL text never changes per query, so asyncpg's per-connection
+    # prepared statement cache serves every search after the first one
+    return text(
+        f"""SELECT * FROM {distance_fn}(
+    :query_embeddings,
+    :match_threshold,
+    :match_count,
+    :filter_project_id,
+    :filter_organization_id)"""
+    ).bindparams(
+        bindparam("query_embeddings", type_=Vector(VECTOR_EMBEDDINGS_COUNT)),
+        bindparam("match_threshold", type_=Float),
+        bindparam("match_count", type_=Integer),
+        bindparam("filter_project_id", type_=Integer),
+        bindparam("filter_organization_id", type_=Integer),
+    )
+
+
+def get_search_settings_query(
+    probes: Optional[int] = None, ef_search: Optional[int] = None
+) -> Tuple[Optional[Any], Dict[str, str]]:
+    # Per-query ANN knobs, scoped to the current transaction by set_config(..., true)
+    settings = []
+    params = {}
+    if probes:
+        settings.append("set_config('ivfflat.probes', :probes, true)")
+        params["probes"] = str(int(probes))
+    if ef_search:
+        settings.append("set_config('hnsw.ef_search', :ef_search, true)")
+        params["ef_search"] = str(int(ef_search))
+
+    return (text(f"SELECT {', '.join(settings)}") if settings else None), params
+
+
+def get_match_nodes_params(
+    embeddings: List[float],
+    k: int,
+    distance_threshold: float,
+    project_id: Optional[int] = None,
+    organization_id: Optional[int] = None,
+) -> Dict[str, Any]:
+    return {
+        "query_embeddings": embeddings,
+        "match_threshold": float(distance_threshold),
+        "match_count": int(k),
+        "filter_project_id": project_id,
+        "filter_organization_id": organization_id,
+    }
+
+
+def get_nodes_by_embedding(
+    embeddings: List[float],
+    k: int = LLM_MIN_NODE_LIMIT,
+    distance_strategy: Optional[DISTANCE_STRATEGY] = LLM_DEFAULT_DISTANCE_STRATEGY,
+    distance_threshold: Optional[float] = LLM_DISTANCE_THRESHOLD,
+    project_id: Optional[int] = None,
+    organization_id: Optional[int] = None,
+    probes: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    session: Optional[Session] = None,
+) -> List[NodeReadResult]:
+    # Hot projects can be served from the in-process index
+    if is_memory_indexed(project_id):
+        return get_project_index(project_id, session=session).search(
+            embeddings, k, distance_strategy, distance_threshold
+        )
+
     # ---------------------------
     # Lets do a similarity search
     # ---------------------------
-    sql = f"""SELECT * FROM {distance_fn}(
-    '{embeddings_str}'::vector({VECTOR_EMBEDDINGS_COUNT}),
-    {float(distance_threshold)}::double precision,
-    {int(k)});"""
+    query = get_match_nodes_query(distance_strategy)
+    params = get_match_nodes_params(
+        embeddings, k, distance_threshold, project_id, organization_id
+    )
 
-    # logger.debug(f'🔍 Query: {sql}')
+    settings_query, settings_params = get_search_settings_query(probes, ef_search)
 
-    # Execute query, convert results to Node objects
+    # Execute query, the search function returns fully hydrated rows
     if not session:
         with Session(get_engine()) as session:
-            nodes = session.exec(text(sql)).all()
+            if settings_query is not None:
+                session.execute(settings_query, settings_params)
+            nodes = session.execute(query, params).all()
     else:
-        nodes = session.exec(text(sql)).all()
+        if settings_query is not None:
+            session.execute(settings_query, settings_params)
+        nodes = session.execute(query, params).all()
 
-    return [Node.by_uuid(str(node[0])) for node in nodes] if nodes else []
+    return [NodeReadResult(**node._mapping) for node in nodes]
+
+
+async def get_nodes_by_embedding_async(
+    embeddings: List[float],
+    k: int = LLM_MIN_NODE_LIMIT,
+    distance_strategy: Optional[DISTANCE_STRATEGY] = LLM_DEFAULT_DISTANCE_STRATEGY,
+    distance_threshold: Optional[float] = LLM_DISTANCE_THRESHOLD,
+    project_id: Optional[int] = None,
+    organization_id: Optional[int] = None,
+    probes: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    session: AsyncSession = None,
+) -> List[NodeReadResult]:
+    # Hot projects can be served from the in-process index
+    if is_memory_indexed(project_id):
+        index = await get_project_index_async(project_id, session=session)
+        return index.search(embeddings, k, distance_strategy, distance_threshold)
+
+    query = get_match_nodes_query(distance_strategy)
+    params = get_match_nodes_params(
+        embeddings, k, distance_threshold, project_id, organization_id
+    )
+
+    settings_query, settings_params = get_search_settings_query(probes, ef_search)
+
+    if settings_query is not None:
+        await session.execute(settings_query, settings_params)
+    nodes = (await session.execute(query, params)).all()
+
+    return [NodeReadResult(**node._mapping) for node in nodes]
 
 
 # --------------
 # Queries OpenAI
 # --------------
-def retrieve_llm_response(
+def is_chat_model(model_name: str) -> bool:
+    return model_name.startswith("gpt-")
+
+
+def get_llm_messages(
+    query_str: str, prefix_messages: Optional[List[dict]] = None
+) -> List[Dict[str, str]]:
+    return (prefix_messages or []) + [{"role": "user", "content": query_str}]
+
+
+def get_llm_error(e: OpenAIError) -> HTTPException:
+    logger.error(f"🚨 LLM error: {e}")
+    return HTTPException(
+        status_code=503 if isinstance(e, CircuitOpenError) else 500,
+        detail=f"LLM error: {e}",
+    )
+
+
+async def retrieve_llm_response(
     query_str: str,
     model: Optional[LLM_MODELS] = LLM_MODELS.GPT_35_TURBO,
     temperature: Optional[float] = LLM_DEFAULT_TEMPERATURE,
     max_output_tokens: Optional[int] = LLM_MAX_OUTPUT_TOKENS,
     prefix_messages: Optional[List[dict]] = None,
 ):
-    llm = OpenAI(
-        temperature=temperature,
-        model_name=model.model_name
-        if isinstance(model, LLM_MODELS)
-        else LLM_MODELS.GPT_35_TURBO.model_name,
-        max_tokens=max_output_tokens,
-        prefix_messages=prefix_messages,
-    )
+    model_name = get_model_name(model)
+    params = {"temperature": temperature, "max_tokens": max_output_tokens}
     try:
-        result = llm(prompt=query_str)
-    except openai.error.InvalidRequestError as e:
-        logger.error(f"🚨 LLM error: {e}")
-        raise HTTPException(status_code=500, detail=f"LLM error: {e}")
+        if is_chat_model(model_name):
+            result = await get_openai_client().chat_completion(
+                get_llm_messages(query_str, prefix_messages), model_name, **params
+            )
+        else:
+            # Completion models take a single prompt, as langchain's OpenAI did
+            result = await get_openai_client().completion(query_str, model_name, **params)
+    except OpenAIError as e:
+        raise get_llm_error(e)
     logger.debug(f"💬 LLM result: {str(result)}")
     return sanitize_output(result)
 
 
+# ----------------------------------------------
+# Streams OpenAI completion text as it arrives
+# ----------------------------------------------
+async def stream_llm_response(
+    query_str: str,
+    model: Optional[LLM_MODELS] = LLM_MODELS.GPT_35_TURBO,
+    temperature: Optional[float] = LLM_DEFAULT_TEMPERATURE,
+    max_output_tokens: Optional[int] = LLM_MAX_OUTPUT_TOKENS,
+    prefix_messages: Optional[List[dict]] = None,
+) -> AsyncIterator[str]:
+    model_name = get_model_name(model)
+    params = {"temperature": temperature, "max_tokens": max_output_tokens}
+    if is_chat_model(model_name):
+        stream = get_openai_client().stream_chat_completion(
+            get_llm_messages(query_str, prefix_messages), model_name, **params
+        )
+    else:
+        stream = get_openai_client().stream_completion(query_str, model_name, **params)
+
+    try:
+        async for text in stream:
+            yield text
+    except OpenAIError as e:
+        raise get_llm_error(e)
+
+
+# ----------------------------------------------------------
+# Streaming variant of chat_query's LLM stage. Yields
+# (event, data) pairs: "token" for each decoded piece of the
+# answer's "message" field, then "done" once the ChatSession
+# is saved
+# ----------------------------------------------------------
+async def stream_chat_query(
+    chat: ChatQuery,
+    session: AsyncSession,
+    channel: Optional[CHANNEL_TYPE] = None,
+    identifier: Optional[str] = None,
+    user_data: Optional[Dict[str, Any]] = None,
+    started_at: Optional[float] = None,
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    started_at = started_at or time.perf_counter()
+    first_token = True
+
+    def on_token():
+        nonlocal first_token
+        if first_token:
+            observe("chat.ttft_ms", (time.perf_counter() - started_at) * 1000)
+            first_token = False
+
+    if chat.needs_llm:
+        parser = JSONStringFieldParser("message")
+        message = []
+
+        async for text in stream_llm_response(
+            chat.user_prompt,
+            model=chat.model,
+            temperature=chat.temperature,
+            max_output_tokens=chat.max_output_tokens,
+            prefix_messages=chat.system_prompt,
+        ):
+            delta = parser.feed(text)
+            if delta:
+                on_token()
+                message.append(delta)
+                yield "token", {"text": delta}
+
+        try:
+            llm_response = json.loads(sanitize_output(parser.text))
+        except (ValueError, IndexError):
+            # Keep what the user already saw, but don't cache a broken answer
+            logger.warning(f"🚨 Streamed LLM response is not valid JSON: {parser.text}")
+            chat.response_message = "".join(message) or None
+        else:
+            await set_chat_response(chat, llm_response, session=session)
+    elif chat.response_message:
+        on_token()
+        yield "token", {"text": chat.response_message}
+
+    chat_session = await save_chat_session(
+        chat,
+        session=session,
+        channel=channel,
+        identifier=identifier,
+        user_data=user_data,
+    )
+    observe("chat.stream_ms", (time.perf_counter() - started_at) * 1000)
+
+    yield "done", {
+        "id": chat_session.id,
+        "session_id": chat.session_id,
+        "response": chat_session.response,
+        "tags": chat.tags,
+        "is_escalate": chat.is_escalate,
+        "meta": chat_session.meta,
+    }
+
+
 # --------------------------
 # Create document embeddings
 # --------------------------
-def get_embeddings(
+def split_document(
     document_data: str,
     document_type: DOCUMENT_TYPE = DOCUMENT_TYPE.PLAINTEXT,
-) -> Tuple[List[str], List[float]]:
+) -> List[str]:
     documents = [LangChainDocument(page_content=document_data)]
 
     logger.debug(documents)
@@ -442,13 +1043,277 @@ def get_embeddings(
     split_documents = doc_splitter.split_documents(documents)
 
     # Lets convert them into an array of strings for OpenAI
-    arr_documents = [doc.page_content for doc in split_documents]
+    return [doc.page_content for doc in split_documents]
+
+
+def get_embedding_batches(
+    token_counts: List[int],
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+) -> List[Tuple[int, int]]:
+    # (start, end) slices of at most batch_size texts and max_tokens tokens
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for i, token_count in enumerate(token_counts):
+        if i > start and (i - start >= batch_size or batch_tokens + token_count > max_tokens):
+            batches.append((start, i))
+            start, batch_tokens = i, 0
+        batch_tokens += token_count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+def embed_documents(
+    texts: List[str],
+    token_counts: Optional[List[int]] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> List[List[float]]:
+    token_counts = token_counts or get_token_counts(texts)
+    batches = get_embedding_batches(token_counts)
+    embeddings: List[Optional[List[float]]] = [None] * len(texts)
+    done = 0
 
-    # https://github.com/hwchase17/langchain/blob/d18b0caf0e00414e066c9903c8df72bb5bcf9998/langchain/embeddings/openai.py#L219
-    embed_func = OpenAIEmbeddings()
+    def embed_batch(start: int, end: int) -> List[List[float]]:
+        return get_openai_client().embeddings_sync(
+            [get_embedding_input(text) for text in texts[start:end]], EMBEDDING_MODEL
+        )
+
+    # Ingestion runs in a worker thread; batches go out concurrently, the
+    # client's own semaphores still bound the total across documents
+    with ThreadPoolExecutor(max_workers=max(1, EMBEDDING_CONCURRENCY)) as executor:
+        futures = {
+            executor.submit(embed_batch, start, end): (start, end)
+            for start, end in batches
+        }
+        for future in as_completed(futures):
+            start, end = futures[future]
+            embeddings[start:end] = future.result()
+            done += end - start
+            if on_progress:
+                on_progress(done, len(texts))
+
+    return embeddings
+
+
+def get_embeddings(
+    document_data: str,
+    document_type: DOCUMENT_TYPE = DOCUMENT_TYPE.PLAINTEXT,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[List[str], List[float]]:
+    arr_documents = split_document(document_data, document_type)
+    return arr_documents, embed_documents(arr_documents, on_progress=on_progress)
+
+
+# ------------------------------------------
+# Create query embeddings (two tier cached)
+# ------------------------------------------
+embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE)
+
+
+def get_embedding_input(text: str) -> str:
+    # OpenAI recommends replacing newlines for ada embeddings, as langchain did
+    return text.replace("\n", " ")
+
+
+async def embed_queries(query_strs: List[str]) -> List[List[float]]:
+    return await get_openai_client().embeddings(
+        [get_embedding_input(query_str) for query_str in query_strs], EMBEDDING_MODEL
+    )
+
+
+# Concurrent chat queries share one embeddings request
+query_embedding_batcher = MicroBatcher(
+    embed_queries,
+    max_batch_size=EMBEDDING_QUERY_BATCH_SIZE,
+    max_wait_ms=EMBEDDING_QUERY_BATCH_WAIT_MS,
+    name="embedding_batcher",
+)
+
+
+async def embed_query(query_str: str) -> List[float]:
+    try:
+        return await query_embedding_batcher.submit(query_str)
+    except OpenAIError as e:
+        raise get_llm_error(e)
+
+
+async def get_query_embeddings(
+    query_str: str, session: AsyncSession
+) -> List[float]:
+    if not EMBEDDING_CACHE_ENABLED:
+        return await embed_query(query_str)
+
+    # Queries that only differ by case or whitespace share one cache entry,
+    # but the text sent for embedding is the query as the user wrote it
+    query_hash = get_cache_key(normalize_query(query_str))
+
+    embeddings = embedding_cache.get((query_hash, EMBEDDING_MODEL))
+    if embeddings is not None:
+        increment("embedding_cache.memory_hit")
+        return embeddings
+
+    if EMBEDDING_CACHE_PERSIST:
+        embeddings = (
+            await session.exec(
+                select(EmbeddingCache.embeddings).where(
+                    EmbeddingCache.query_hash == query_hash,
+                    EmbeddingCache.model == EMBEDDING_MODEL,
+                )
+            )
+        ).first()
+        if embeddings is not None:
+            increment("embedding_cache.db_hit")
+            embedding_cache.set((query_hash, EMBEDDING_MODEL), embeddings)
+            return embeddings
+
+    increment("embedding_cache.miss")
+    embeddings = await embed_query(query_str)
+    embedding_cache.set((query_hash, EMBEDDING_MODEL), embeddings)
+
+    if EMBEDDING_CACHE_PERSIST:
+        await session.execute(
+            pg_insert(EmbeddingCache)
+            .values(
+                query_hash=query_hash,
+                model=EMBEDDING_MODEL,
+                embeddings=embeddings,
+                created_at=datetime.now(),
+            )
+            .on_conflict_do_nothing(constraint="unq_embedding_cache_hash_model")
+        )
+        await session.commit()
 
-    embeddings = embed_func.embed_documents(
-        texts=arr_documents, chunk_size=LLM_CHUNK_SIZE
+    return embeddings
+
+
+# ---------------------------------------------------------
+# Semantic answer cache over previous ChatSessions. Answers
+# expire after the TTL or once the project's documents change
+# ---------------------------------------------------------
+async def get_semantic_cache_hit_async(
+    project: Project,
+    embeddings: List[float],
+    session: AsyncSession,
+) -> Optional[ChatSession]:
+    cutoff = max(
+        datetime.now() - timedelta(seconds=LLM_SEMANTIC_CACHE_TTL),
+        project.updated_at,
     )
+    distance = ChatSession.embeddings.cosine_distance(embeddings)
+
+    result = (
+        await session.exec(
+            select(ChatSession, distance.label("distance"))
+            .where(
+                ChatSession.project_id == project.id,
+                ChatSession.created_at > cutoff,
+                ChatSession.response.isnot(None),
+                ChatSession.meta["is_escalate"].as_boolean().isnot(True),
+                # Only original answers, so a reply can't outlive its TTL
+                ~ChatSession.meta.has_key("cache"),
+            )
+            .order_by(distance)
+            .limit(1)
+        )
+    ).first()
+
+    if result and 1 - result.distance >= LLM_SEMANTIC_CACHE_THRESHOLD:
+        increment("semantic_cache.hit")
+        return result.ChatSession
+
+    increment("semantic_cache.miss")
+    return None
+
 
-    return arr_documents, embeddings
\ No newline at end of file
+# --------------------------------------------
+# Resolve a model from its enum or model name
+# --------------------------------------------
+def get_llm_model(model: Union[LLM_MODELS, str, None]) -> LLM_MODELS:
+    if not model:
+        return LLM_MODELS.GPT_35_TURBO
+    if isinstance(model, LLM_MODELS):
+        return model
+    for llm_model in LLM_MODELS:
+        if model in (llm_model.model_name, llm_model.name):
+            return llm_model
+
+    raise HTTPException(status_code=422, detail=f"Unknown model {model}")
+
+
+# ------------------------------------------------------------
+# Exact response cache. Node ids are part of the key, so a
+# replaced or deprecated node can never produce a hit again;
+# deprecate_document() also deletes the rows that reference it
+# ------------------------------------------------------------
+response_cache = LRUCache(LLM_RESPONSE_CACHE_SIZE)
+
+
+def get_model_name(model: Optional[LLM_MODELS]) -> str:
+    return (
+        model.model_name
+        if isinstance(model, LLM_MODELS)
+        else LLM_MODELS.GPT_35_TURBO.model_name
+    )
+
+
+def get_response_cache_key(
+    query_str: str,
+    nodes: List[NodeReadResult],
+    model: Optional[LLM_MODELS],
+    temperature: float,
+) -> str:
+    # Retrieval order decides the prompt, so it is part of the key
+    return get_cache_key(
+        normalize_query(query_str),
+        ",".join(str(node.id) for node in nodes),
+        get_model_name(model),
+        float(temperature),
+    )
+
+
+async def get_response_cache_hit_async(
+    cache_key: str, session: AsyncSession
+) -> Optional[Dict[str, Any]]:
+    response = response_cache.get(cache_key)
+    if response is not None:
+        increment("response_cache.memory_hit")
+        return response
+
+    response = (
+        await session.exec(
+            select(ResponseCache.response).where(ResponseCache.cache_key == cache_key)
+        )
+    ).first()
+    if response is not None:
+        increment("response_cache.db_hit")
+        response_cache.set(cache_key, response)
+        return response
+
+    increment("response_cache.miss")
+    return None
+
+
+async def set_response_cache_async(
+    cache_key: str,
+    nodes: List[NodeReadResult],
+    model: Optional[LLM_MODELS],
+    temperature: float,
+    response: Dict[str, Any],
+    session: AsyncSession,
+):
+    response_cache.set(cache_key, response)
+    await session.execute(
+        pg_insert(ResponseCache)
+        .values(
+            cache_key=cache_key,
+            node_ids=[node.id for node in nodes],
+            model=get_model_name(model),
+            temperature=float(temperature),
+            response=response,
+            created_at=datetime.now(),
+        )
+        .on_conflict_do_nothing(constraint="unq_response_cache_key")
+    )
+    await session.commit()
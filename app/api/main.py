@@ -1,13 +1,17 @@
 from fastapi import (
+    BackgroundTasks,
     FastAPI,
     File,
     Depends,
     HTTPException,
+    Query,
     UploadFile
 )
 from fastapi.openapi.utils import get_openapi
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel import Session
 
 from typing import (
     List,
@@ -16,7 +20,7 @@ from typing import (
     Any
 )
 from datetime import datetime
-import requests
+import mimetypes
 import aiohttp
 import time
 import json
@@ -26,8 +30,14 @@ import os
 # LLM imports
 # -----------
 from llm import (
-    chat_query
+    chat_query,
+    prepare_chat_query,
+    stream_chat_query,
+    get_llm_model,
+    embedding_cache
 )
+from metrics import get_metrics, get_timings
+from openai_client import get_openai_client, close_openai_client
 
 # ----------------
 # Database imports
@@ -52,13 +62,20 @@ from models import (
     ProjectReadList,
     ChatSessionResponse,
     ChatSessionCreatePost,
+    IngestJobRead,
     WebhookCreate,
     # ------------------
     # Database functions
     # ------------------
-    get_engine,
-    get_session
-
+    get_session,
+    get_async_session,
+    get_async_engine,
+    get_pool_stats,
+    get_vector_index_status,
+    ensure_vector_index,
+    iter_decompressed,
+    dispose_engines,
+    dispose_async_engines
 )
 from helpers import (
     # ----------------
@@ -66,16 +83,31 @@ from helpers import (
     # ----------------
     get_org_by_uuid_or_namespace,
     get_project_by_uuid,
-    get_user_by_uuid_or_identifier,
-    get_users,
-    get_documents_by_project_and_org,
-    get_document_by_uuid,
     create_org_by_org_or_uuid,
-    create_project_by_org
+    create_project_by_org,
+    # ----------------------
+    # Async helper functions
+    # ----------------------
+    get_org_by_uuid_or_namespace_async,
+    get_orgs_async,
+    get_projects_by_org_async,
+    get_project_by_uuid_async,
+    get_user_by_uuid_or_identifier_async,
+    get_users_async,
+    get_documents_by_project_and_org_async,
+    get_document_by_uuid_async,
+    get_document_file_async,
+    get_document_by_hash_async,
+    create_ingest_job_async,
+    get_ingest_job_by_uuid_async,
+    retry_ingest_job_async
 )
 from util import (
+    format_sse,
+    get_page_response,
+    parse_fields,
     save_file,
-    get_sha256,
+    save_stream,
     is_uuid,
     logger
 )
@@ -89,11 +121,16 @@ from config import (
     ENTITY_STATUS,
     CHANNEL_TYPE,
     LLM_MODELS,
+    DISTANCE_STRATEGY,
     LLM_DISTANCE_THRESHOLD,
     LLM_DEFAULT_DISTANCE_STRATEGY,
     LLM_MAX_OUTPUT_TOKENS,
     LLM_MIN_NODE_LIMIT,
     FILE_UPLOAD_PATH,
+    FILE_UPLOAD_MAX_SIZE,
+    FILE_UPLOAD_CHUNK_SIZE,
+    PAGE_DEFAULT_LIMIT,
+    PAGE_MAX_LIMIT,
     RASA_WEBHOOK_URL
 )
 
@@ -115,6 +152,30 @@ def health_check():
     return {'status': 'ok'}
 
 
+# -----------------------
+# Runtime stats endpoint
+# -----------------------
+@app.get("/stats", include_in_schema=False)
+def stats():
+    return {
+        'db_pool': get_pool_stats(),
+        'counters': get_metrics(),
+        'timings': get_timings(),
+        'openai_circuit': get_openai_client().breaker.state,
+        'embedding_cache_size': len(embedding_cache)
+    }
+
+
+# ------------------------------------
+# Release pooled connections on exit
+# ------------------------------------
+@app.on_event("shutdown")
+async def shutdown():
+    dispose_engines()
+    await dispose_async_engines()
+    await close_openai_client()
+
+
 # ======================
 # ORGANIZATION ENDPOINTS
 # ======================
@@ -123,17 +184,28 @@ def health_check():
 # Get all organizations
 # ---------------------
 @app.get("/org", response_model=List[OrganizationRead])
-def read_organizations():
+async def read_organizations(
+    *,
+    session: AsyncSession = Depends(get_async_session),
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
     '''
     ## Get all active organizations
 
+    Args:
+        limit: Page size, at most PAGE_MAX_LIMIT
+        cursor: X-Next-Cursor header of the previous page
+        fields: Comma separated fields to return (ex. uuid,namespace)
+
     Returns:
         List[OrganizationRead]: List of organizations
 
     '''
-    with Session(get_engine()) as session:
-        orgs = session.exec(select(Organization).where(Organization.status == ENTITY_STATUS.ACTIVE.value)).all()
-        return orgs
+    fields = parse_fields(fields, OrganizationRead)
+    orgs, next_cursor = await get_orgs_async(session=session, limit=limit, cursor=cursor)
+    return get_page_response(orgs, next_cursor, OrganizationRead, fields)
 
 
 # ----------------------
@@ -184,13 +256,13 @@ def create_organization(
 # Get an organization by UUID
 # ---------------------------
 @app.get("/org/{organization_id}", response_model=Union[OrganizationRead, Any])
-def read_organization(
+async def read_organization(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     organization_id: str
 ):
 
-    organization = get_org_by_uuid_or_namespace(organization_id, session=session)
+    organization = await get_org_by_uuid_or_namespace_async(organization_id, session=session)
 
     return organization
 
@@ -220,18 +292,27 @@ def update_organization(
 # Get all projects by org
 # -----------------------
 @app.get("/project", response_model=List[ProjectReadList])
-def read_projects(
+async def read_projects(
     *,
-    session: Session = Depends(get_session),
-    organization_id: str
+    session: AsyncSession = Depends(get_async_session),
+    organization_id: str,
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
 ):
+    fields = parse_fields(fields, ProjectReadList)
+    projects, next_cursor = await get_projects_by_org_async(
+        organization_id,
+        session=session,
+        limit=limit,
+        cursor=cursor,
+        load_documents=not fields or 'documents' in fields
+    )
 
-    organization = get_org_by_uuid_or_namespace(organization_id, session=session)
-
-    if not organization.projects:
+    if not projects and not cursor:
         raise HTTPException(status_code=404, detail='No projects found for organization')
 
-    return organization.projects
+    return get_page_response(projects, next_cursor, ProjectReadList, fields)
 
 
 # -----------------------
@@ -255,14 +336,14 @@ def create_project(
 # Get a project by UUID and org
 # -----------------------------
 @app.get("/project/{project_id}", response_model=Union[ProjectRead, Any])
-def read_project(
+async def read_project(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     organization_id: str,
     project_id: str
 ):
 
-    return get_project_by_uuid(uuid=project_id, organization_id=organization_id, session=session)
+    return await get_project_by_uuid_async(uuid=project_id, organization_id=organization_id, session=session)
 
 
 # ==================
@@ -272,22 +353,22 @@ def read_project(
 # ---------------
 # Upload document
 # ---------------
-@app.post("/document", response_model=Union[DocumentReadList, Any])
+@app.post("/document", response_model=IngestJobRead, status_code=202)
 async def upload_document(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     organization_id: str,
     project_id: str,
     url: Optional[str] = None,
     file: Optional[UploadFile] = File(...),
     overwrite: Optional[bool] = True
 ):
-    organization = get_org_by_uuid_or_namespace(organization_id, session=session)
-    project = get_project_by_uuid(uuid=project_id, organization_id=organization_id, session=session)
+    organization = await get_org_by_uuid_or_namespace_async(organization_id, session=session)
+    project = await get_project_by_uuid_async(
+        uuid=project_id, organization_id=organization_id, session=session, load_documents=False
+    )
     file_root_path = os.path.join(FILE_UPLOAD_PATH, str(organization.uuid), str(project.uuid))
 
-    file_version = 1
-
     # ------------------------
     # Enforce XOR for url/file
     # ------------------------
@@ -306,20 +387,20 @@ async def upload_document(
             file_name = f'{file_name}_{int(time.time())}'
             file_upload_path = os.path.join(file_root_path, file_name)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
+        async with aiohttp.ClientSession() as client:
+            async with client.get(url) as resp:
                 if resp.status != 200:
                     raise HTTPException(status_code=400, detail=f'Could not download file from {url}')
 
-                with open(file_upload_path, 'wb') as f:
-                    while True:
-                        chunk = await resp.content.read(1024)
-                        if not chunk:
-                            break
-                        f.write(chunk)
+                # Refuse early when the server tells us the file is too large
+                if resp.content_length and resp.content_length > FILE_UPLOAD_MAX_SIZE:
+                    raise HTTPException(
+                        status_code=413, detail=f'File is larger than the {FILE_UPLOAD_MAX_SIZE} byte limit'
+                    )
 
-        file_contents = open(file_upload_path, 'rb').read()
-        file_hash = get_sha256(contents=file_contents)
+                _, file_hash = await save_stream(
+                    resp.content.iter_chunked(FILE_UPLOAD_CHUNK_SIZE), file_upload_path
+                )
 
     # -----------------------
     # Upload file from device
@@ -333,47 +414,119 @@ async def upload_document(
             file_name = f'{file_name}_{int(time.time())}'
             file_upload_path = os.path.join(file_root_path, file_name)
 
-        file_contents = await file.read()
-        file_hash = get_sha256(contents=file_contents)
-        await save_file(file, file_upload_path)
-
-    document_obj = create_document_by_file_path(
+        # One pass: chunks are hashed as they are written
+        _, file_hash = await save_file(file, file_upload_path)
+
+    # ------------------------------------------------------
+    # Reject duplicate content now rather than in the worker
+    # ------------------------------------------------------
+    if await get_document_by_hash_async(file_hash, session=session):
+        os.remove(file_upload_path)
+        raise HTTPException(
+            status_code=409,
+            detail=f'Document "{file_name}" already uploaded! \n\nsha256:{file_hash}!',
+        )
+
+    # Chunking and embedding run in worker.py, poll GET /job/{job_id} for progress
+    job = await create_ingest_job_async(
         organization=organization,
         project=project,
         file_path=file_upload_path,
         file_hash=file_hash,
-        file_version=file_version,
         url=url,
         overwrite=overwrite,
         session=session
     )
-    return document_obj
+
+    return job
+
+
+# ------------------------
+# Get an ingest job by UUID
+# ------------------------
+@app.get("/job/{job_id}", response_model=IngestJobRead)
+async def read_ingest_job(
+    *,
+    session: AsyncSession = Depends(get_async_session),
+    job_id: str
+):
+    return await get_ingest_job_by_uuid_async(uuid=job_id, session=session)
+
+
+# -----------------------
+# Retry a failed ingest job
+# -----------------------
+@app.post("/job/{job_id}/retry", response_model=IngestJobRead, status_code=202)
+async def retry_ingest_job(
+    *,
+    session: AsyncSession = Depends(get_async_session),
+    job_id: str
+):
+    job = await get_ingest_job_by_uuid_async(uuid=job_id, session=session)
+    return await retry_ingest_job_async(job, session=session)
 
 
 # --------------------------------
 # List all documents for a project
 # --------------------------------
 @app.get("/document", response_model=List[DocumentReadList])
-def read_documents(
+async def read_documents(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     organization_id: str,
-    project_id: str
+    project_id: str,
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
 ):
-    return get_documents_by_project_and_org(project_id=project_id, organization_id=organization_id, session=session)
+    fields = parse_fields(fields, DocumentReadList)
+    documents, next_cursor = await get_documents_by_project_and_org_async(
+        project_id=project_id,
+        organization_id=organization_id,
+        session=session,
+        limit=limit,
+        cursor=cursor,
+        load_nodes=not fields or 'nodes' in fields
+    )
+    return get_page_response(documents, next_cursor, DocumentReadList, fields)
 
 # ----------------------
 # Get a document by UUID
 # ----------------------
 @app.get("/document/{document_id}", response_model=DocumentRead)
-def read_document(
+async def read_document(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
+    organization_id: str,
+    project_id: str,
+    document_id: str
+):
+    return await get_document_by_uuid_async(uuid=document_id, project_id=project_id, organization_id=organization_id, session=session)
+
+
+# ------------------------------
+# Download a document's raw file
+# ------------------------------
+@app.get("/document/{document_id}/file", response_class=StreamingResponse)
+async def read_document_file(
+    *,
+    session: AsyncSession = Depends(get_async_session),
     organization_id: str,
     project_id: str,
     document_id: str
 ):
-    return get_document_by_uuid(uuid=document_id, project_id=project_id, organization_id=organization_id, session=session)
+    document = await get_document_by_uuid_async(uuid=document_id, project_id=project_id, organization_id=organization_id, session=session)
+    data, size = await get_document_file_async(document, session=session)
+
+    # Decompressed chunk by chunk as the response is sent
+    return StreamingResponse(
+        iter_decompressed(data, chunk_size=FILE_UPLOAD_CHUNK_SIZE),
+        media_type=mimetypes.guess_type(document.display_name)[0] or 'application/octet-stream',
+        headers={
+            'Content-Length': str(size),
+            'Content-Disposition': f'attachment; filename="{document.display_name}"',
+        }
+    )
 
 
 # ==============
@@ -384,11 +537,16 @@ def read_document(
 # Get all users
 # -------------
 @app.get("/user", response_model=List[UserReadList])
-def read_users(
+async def read_users(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
 ):
-    return get_users(session=session)
+    fields = parse_fields(fields, UserReadList)
+    users, next_cursor = await get_users_async(session=session, limit=limit, cursor=cursor)
+    return get_page_response(users, next_cursor, UserReadList, fields)
 
 
 # -------------
@@ -411,13 +569,13 @@ def create_user(
 # Get a user by UUID
 # ------------------
 @app.get("/user/{user_uuid}", response_model=UserRead)
-def read_user(
+async def read_user(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     user_id: str
 ):
 
-    return get_user_by_uuid_or_identifier(id=user_id, session=session)
+    return await get_user_by_uuid_or_identifier_async(id=user_id, session=session, load_chat_sessions=True)
 
 
 # ---------------------
@@ -439,6 +597,43 @@ def update_user(*, user_uuid: str, user: UserUpdate):
         raise HTTPException(status_code=404, detail=f'User {user_uuid} not found!')
 
 
+# ===============
+# ADMIN ENDPOINTS
+# ===============
+
+# -------------------------------
+# Vector index lifecycle status
+# -------------------------------
+@app.get("/admin/vector-index")
+def read_vector_index():
+    '''
+    ## Get the state of the node embedding indexes
+
+    Returns the active node count, each configured index (validity, rows at
+    build time, size) and whether it is due to be built or retrained.
+    '''
+    return get_vector_index_status()
+
+
+# ----------------------------------
+# Build or retrain the vector index
+# ----------------------------------
+@app.post("/admin/vector-index", status_code=202)
+def update_vector_index(
+    *,
+    background_tasks: BackgroundTasks,
+    force: Optional[bool] = False
+):
+    '''
+    ## Build or retrain the node embedding indexes in the background
+
+    Indexes are built `CONCURRENTLY` so ingest and search keep running. Pass
+    `force=true` to rebuild even if the row count has not crossed a threshold.
+    '''
+    background_tasks.add_task(ensure_vector_index, force=force)
+    return get_vector_index_status()
+
+
 # =============
 # LLM ENDPOINTS
 # =============
@@ -486,9 +681,9 @@ def process_webhook_telegram(webhook_data: dict):
 
 
 @app.post("/webhooks/{channel}/webhook")
-def get_webhook(
+async def get_webhook(
     *,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     channel: str,
     webhook: WebhookCreate
 ):
@@ -502,7 +697,7 @@ def get_webhook(
         data = process_webhook_telegram(webhook_data)
         channel = CHANNEL_TYPE.TELEGRAM.value
         user_data = {
-            'identifier': data['user_id'],
+            'identifier': str(data['user_id']),
             'identifier_type': channel,
             'first_name': data['user_firstname'],
             'language': data['user_language']
@@ -519,7 +714,7 @@ def get_webhook(
         # Not a valid channel, return 404
         raise HTTPException(status_code=404, detail=f'Channel {channel} not a valid webhook channel!')
 
-    chat_session = chat_query(
+    chat_session = await chat_query(
         user_message,
         session=session,
         channel=channel,
@@ -544,12 +739,83 @@ def get_webhook(
     # -----------------------------------
     # Forward the webhook to Rasa webhook
     # -----------------------------------
-    res = requests.post(rasa_webhook_url, data=json.dumps(webhook_data))
-    logger.debug(f'[🤖 RasaGPT API webhook]\nPosting data: {json.dumps(webhook_data)}\n\n[🤖 RasaGPT API webhook]\nRasa webhook response: {res.text}')
+    async with aiohttp.ClientSession() as client:
+        async with client.post(rasa_webhook_url, data=json.dumps(webhook_data)) as res:
+            res_text = await res.text()
+    logger.debug(f'[🤖 RasaGPT API webhook]\nPosting data: {json.dumps(webhook_data)}\n\n[🤖 RasaGPT API webhook]\nRasa webhook response: {res_text}')
 
     return {'status': 'ok'}
 
 
+# ------------------------------------------------------
+# Stream a chat answer as Server-Sent Events: "token"
+# events carry the answer as it is generated, "done" the
+# saved ChatSession's id, tags and escalation flag
+# ------------------------------------------------------
+@app.post("/chat/stream")
+async def chat_stream(chat_params: ChatSessionCreatePost):
+    started_at = time.perf_counter()
+
+    # The session has to outlive this handler, it is closed when the stream ends
+    session = AsyncSession(get_async_engine(), expire_on_commit=False)
+    try:
+        organization = (
+            await get_org_by_uuid_or_namespace_async(chat_params.organization_id, session=session)
+            if chat_params.organization_id
+            else None
+        )
+        project = (
+            await get_project_by_uuid_async(chat_params.project_id, organization.uuid, session=session)
+            if chat_params.project_id and organization
+            else None
+        )
+
+        try:
+            distance_strategy = DISTANCE_STRATEGY(chat_params.distance_strategy)
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f'Invalid distance strategy {chat_params.distance_strategy}')
+
+        chat = await prepare_chat_query(
+            chat_params.query,
+            session=session,
+            session_id=chat_params.session_id or None,
+            project=project,
+            organization=organization,
+            distance_strategy=distance_strategy,
+            node_limit=chat_params.node_limit,
+            model=get_llm_model(chat_params.model),
+            max_output_tokens=chat_params.max_output_tokens,
+            probes=chat_params.probes,
+            ef_search=chat_params.ef_search,
+        )
+    except Exception:
+        await session.close()
+        raise
+
+    async def events():
+        try:
+            async for event, data in stream_chat_query(
+                chat,
+                session=session,
+                channel=chat_params.channel,
+                identifier=chat_params.identifier,
+                started_at=started_at,
+            ):
+                yield format_sse(event, data)
+        except Exception as e:
+            # Headers are already sent, report the failure in-band
+            logger.error(f'🚨 Chat stream failed: {e}')
+            yield format_sse('error', {'detail': getattr(e, 'detail', str(e))})
+        finally:
+            await session.close()
+
+    return StreamingResponse(
+        events(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 # ------------------
 # Customize API docs
 # ------------------
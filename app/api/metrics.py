@@ -0,0 +1,42 @@
+'''
+metrics.py keeps process-local counters and timings for the /stats endpoint
+'''
+from collections import defaultdict, deque
+from threading import Lock
+from typing import Dict
+
+TIMING_WINDOW = 1000  # most recent observations kept per timing
+
+_counters: Dict[str, int] = defaultdict(int)
+_timings: Dict[str, deque] = defaultdict(lambda: deque(maxlen=TIMING_WINDOW))
+_lock = Lock()
+
+
+def increment(name: str, value: int = 1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, value: float):
+    with _lock:
+        _timings[name].append(value)
+
+
+def get_metrics() -> Dict[str, int]:
+    with _lock:
+        return dict(_counters)
+
+
+def get_timings() -> Dict[str, Dict[str, float]]:
+    with _lock:
+        timings = {name: sorted(values) for name, values in _timings.items() if values}
+
+    return {
+        name: {
+            'count': len(values),
+            'p50': values[len(values) // 2],
+            'p95': values[max(int(len(values) * 0.95) - 1, 0)],
+            'max': values[-1],
+        }
+        for name, values in timings.items()
+    }
@@ -1,21 +1,36 @@
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import declared_attr
-from pgvector.sqlalchemy import Vector
-from sqlalchemy import Column
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY, insert as pg_insert
+from sqlalchemy.orm import column_property, declared_attr
+from pgvector.sqlalchemy import Vector as PGVector
+from pgvector.asyncpg import register_vector
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.engine import Engine
+from sqlalchemy import Column, ForeignKey, Integer, LargeBinary, TypeDecorator, event, func
+from sqlalchemy.exc import OperationalError
 from datetime import datetime
+from threading import Lock
+from math import sqrt
 from util import snake_case
 import uuid as uuid_pkg
+import numpy as np
+import zstandard
+import time
+import io
+import os
 
 from sqlmodel import (
     UniqueConstraint,
+    Index,
     create_engine,
     Relationship,
     SQLModel,
     Session,
     select,
     Field,
+    text,
 )
 from typing import (
+    Iterator,
     Optional,
     Union,
     List,
@@ -29,15 +44,93 @@ from config import (
     DISTANCE_STRATEGIES,
     LLM_MIN_NODE_LIMIT,
     PGVECTOR_ADD_INDEX,
+    PGVECTOR_INDEX_TYPE,
+    PGVECTOR_INDEX_STRATEGIES,
+    PGVECTOR_IVFFLAT_LISTS,
+    PGVECTOR_INDEX_SWAP_LOCK_TIMEOUT,
+    PGVECTOR_INDEX_SWAP_RETRIES,
+    PGVECTOR_IVFFLAT_PROBES,
+    PGVECTOR_HNSW_M,
+    PGVECTOR_HNSW_EF_CONSTRUCTION,
+    PGVECTOR_HNSW_EF_SEARCH,
+    PGVECTOR_ITERATIVE_SCAN,
+    PGVECTOR_EXACT_SCAN_MAX_ROWS,
+    PGVECTOR_INDEX_MIN_ROWS,
+    PGVECTOR_INDEX_REBUILD_FACTOR,
+    VECTOR_INDEX_TYPE,
+    DISTANCE_STRATEGY,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_TIMEOUT,
+    DOCUMENT_COMPRESSION_LEVEL,
     ENTITY_STATUS,
     CHANNEL_TYPE,
+    JOB_STATUS,
+    INGEST_MAX_ATTEMPTS,
     LLM_MODELS,
     DB_USER,
     SU_DSN,
+    ASYNC_SU_DSN,
     logger,
 )
 
 
+# ===========
+# Column types
+# ===========
+class Vector(PGVector):
+    """
+    pgvector column that hands float32 arrays straight to asyncpg's binary
+    vector codec (see get_async_engine) instead of formatting them as text.
+    """
+
+    cache_ok = True
+
+    def bind_processor(self, dialect):
+        if dialect.driver != "asyncpg":
+            return super().bind_processor(dialect)
+
+        def process(value):
+            return None if value is None else np.asarray(value, dtype=np.float32)
+
+        return process
+
+    def result_processor(self, dialect, coltype):
+        if dialect.driver != "asyncpg":
+            return super().result_processor(dialect, coltype)
+
+        # The binary codec already decodes to a numpy array
+        return None
+
+
+class CompressedBytes(TypeDecorator):
+    """
+    bytea column that is zstd compressed on write and decompressed on read.
+    Frames carry their content size, so they decompress in one call.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return zstandard.ZstdCompressor(level=DOCUMENT_COMPRESSION_LEVEL).compress(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return zstandard.ZstdDecompressor().decompress(value)
+
+
+def iter_decompressed(value: bytes, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    # Streams a CompressedBytes value without holding the whole file in memory
+    return zstandard.ZstdDecompressor().read_to_iter(io.BytesIO(value), write_size=chunk_size)
+
+
 # ==========
 # Base model
 # ==========
@@ -169,9 +262,7 @@ class User(BaseModel, table=True):
     # -------------
     chat_sessions: Optional[List["ChatSession"]] = Relationship(back_populates="user")
 
-    @property
-    def chat_session_count(self) -> int:
-        return len(self.chat_sessions)
+    # chat_session_count is a COUNT subquery mapped below the ChatSession model
 
     __table_args__ = (
         UniqueConstraint("identifier", "identifier_type", name="unq_id_idtype"),
@@ -239,9 +330,7 @@ class Project(BaseModel, table=True):
         back_populates="project"
     )
 
-    @property
-    def document_count(self) -> int:
-        return len(self.documents)
+    # document_count is a COUNT subquery mapped below the Document model
 
     def __repr__(self):
         return f"<Project id={self.id} name={self.display_name} uuid={self.uuid} project_id={self.uuid}>"
@@ -270,10 +359,9 @@ class Document(BaseModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     uuid: Optional[uuid_pkg.UUID] = Field(unique=True, default_factory=uuid_pkg.uuid4)
     organization_id: int = Field(default=None, foreign_key="organization.id")
-    project_id: int = Field(default=None, foreign_key="project.id")
+    project_id: int = Field(default=None, foreign_key="project.id", index=True)
     display_name: str = Field(default="Untitled Document 😊")
     url: str = Field(default="")
-    data: Optional[bytes] = Field(default=None)
     hash: str = Field(default=None)
     version: Optional[int] = Field(default=1)
     status: Optional[ENTITY_STATUS] = Field(default=ENTITY_STATUS.ACTIVE.value)
@@ -287,16 +375,29 @@ class Document(BaseModel, table=True):
     organization: Optional["Organization"] = Relationship(back_populates="documents")
     project: Optional["Project"] = Relationship(back_populates="documents")
 
-    @property
-    def node_count(self) -> int:
-        return len(self.nodes)
+    # node_count is a COUNT subquery mapped below the Node model, so listing
+    # documents doesn't load their nodes
 
-    __table_args__ = (UniqueConstraint("uuid", "hash", name="unq_org_document"),)
+    __table_args__ = (
+        UniqueConstraint("uuid", "hash", name="unq_org_document"),
+        # Serves the "current version of this file" lookup on upload
+        Index(
+            "ix_document_project_name_active",
+            "project_id",
+            "display_name",
+            postgresql_where=text(f"status = {ENTITY_STATUS.ACTIVE.value}"),
+        ),
+    )
 
     def __repr__(self):
         return f"<Document id={self.id} name={self.display_name} uuid={self.uuid}>"
 
 
+Project.document_count = column_property(
+    select(func.count(Document.id)).where(Document.project_id == Project.id).scalar_subquery()
+)
+
+
 class ProjectRead(SQLModel):
     id: int
     uuid: uuid_pkg.UUID
@@ -329,7 +430,12 @@ class Node(BaseModel, table=True):
         arbitrary_types_allowed = True
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    document_id: int = Field(default=None, foreign_key="document.id")
+    document_id: int = Field(default=None, foreign_key="document.id", index=True)
+    # Denormalized from the document so vector search can filter by tenant
+    project_id: Optional[int] = Field(default=None, foreign_key="project.id")
+    organization_id: Optional[int] = Field(
+        default=None, foreign_key="organization.id"
+    )
     uuid: Optional[uuid_pkg.UUID] = Field(unique=True, default_factory=uuid_pkg.uuid4)
     embeddings: Optional[List[float]] = Field(
         sa_column=Column(Vector(VECTOR_EMBEDDINGS_COUNT))
@@ -337,6 +443,7 @@ class Node(BaseModel, table=True):
     meta: Optional[Dict] = Field(default=None, sa_column=Column(JSONB))
     token_count: Optional[int] = Field(default=None)
     text: str = Field(default=None, nullable=False)
+    chunk_hash: Optional[str] = Field(default=None)  # sha256 of text, see ChunkEmbedding
     status: Optional[ENTITY_STATUS] = Field(default=ENTITY_STATUS.ACTIVE.value)
     created_at: Optional[datetime] = Field(default_factory=datetime.now)
     updated_at: Optional[datetime] = Field(default_factory=datetime.now)
@@ -346,10 +453,74 @@ class Node(BaseModel, table=True):
     # -------------
     document: Optional["Document"] = Relationship(back_populates="nodes")
 
+    # Only ACTIVE nodes are searchable, so the tenant filters only need to
+    # index those rows; deprecated versions drop out of the indexes entirely
+    __table_args__ = (
+        Index(
+            "ix_node_project_active",
+            "project_id",
+            postgresql_where=text(f"status = {ENTITY_STATUS.ACTIVE.value}"),
+        ),
+        Index(
+            "ix_node_organization_active",
+            "organization_id",
+            postgresql_where=text(f"status = {ENTITY_STATUS.ACTIVE.value}"),
+        ),
+    )
+
     def __repr__(self):
         return f"<Node id={self.id} uuid={self.uuid} document={self.document_id}>"
 
 
+Document.node_count = column_property(
+    select(func.count(Node.id)).where(Node.document_id == Document.id).scalar_subquery()
+)
+
+
+# -------------------------------------------------------
+# Raw document file, kept out of the document row so that
+# no listing or lookup ever loads it. Compressed with zstd
+# -------------------------------------------------------
+class DocumentData(BaseModel, table=True):
+    document_id: int = Field(
+        sa_column=Column(
+            Integer, ForeignKey("document.id", ondelete="CASCADE"), primary_key=True
+        )
+    )
+    data: bytes = Field(sa_column=Column(CompressedBytes, nullable=False))
+    size: int = Field(nullable=False)  # uncompressed bytes
+    created_at: datetime = Field(default_factory=datetime.now)
+
+    def __repr__(self):
+        return f"<DocumentData document={self.document_id} size={self.size}>"
+
+
+# --------------------------------------------------------
+# Content addressed embeddings, shared by every document
+# and project. A chunk seen before under the same model is
+# never sent to the embedding API again
+# --------------------------------------------------------
+class ChunkEmbedding(BaseModel, table=True):
+    class Config:
+        arbitrary_types_allowed = True
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    chunk_hash: str = Field(nullable=False)  # sha256 of the chunk text
+    model: str = Field(nullable=False)
+    embeddings: List[float] = Field(
+        sa_column=Column(Vector(VECTOR_EMBEDDINGS_COUNT), nullable=False)
+    )
+    token_count: Optional[int] = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.now)
+
+    __table_args__ = (
+        UniqueConstraint("chunk_hash", "model", name="unq_chunk_embedding_hash_model"),
+    )
+
+    def __repr__(self):
+        return f"<ChunkEmbedding id={self.id} model={self.model} chunk_hash={self.chunk_hash}>"
+
+
 class NodeCreate(SQLModel):
     document: Document
     embeddings: List[float]
@@ -376,9 +547,13 @@ class DocumentReadNodeList(SQLModel):
 
 class NodeReadResult(SQLModel):
     id: int
-    token_count: Optional[int]
+    uuid: uuid_pkg.UUID
     text: str
-    meta: Optional[Dict]
+    token_count: Optional[int]
+    similarity: float
+    document_id: int
+    project_id: Optional[int]
+    organization_id: Optional[int]
 
 
 class ProjectReadListDocumentList(SQLModel):
@@ -440,7 +615,7 @@ class ChatSession(BaseModel, table=True):
     session_id: Optional[uuid_pkg.UUID] = Field(
         index=True, default_factory=uuid_pkg.uuid4
     )
-    user_id: int = Field(default=None, foreign_key="user.id")
+    user_id: int = Field(default=None, foreign_key="user.id", index=True)
     project_id: int = Field(default=None, foreign_key="project.id")
     channel: CHANNEL_TYPE = Field(default=CHANNEL_TYPE.TELEGRAM)
     user_message: str = Field(default=None)
@@ -458,10 +633,20 @@ class ChatSession(BaseModel, table=True):
     user: Optional["User"] = Relationship(back_populates="chat_sessions")
     project: Optional["Project"] = Relationship(back_populates="chat_sessions")
 
+    # Serves the semantic cache's "recent sessions in this project" scan
+    __table_args__ = (
+        Index("ix_chat_session_project_created_at", "project_id", "created_at"),
+    )
+
     def __repr__(self):
         return f"<ChatSession id={self.id} uuid={self.uuid} project_id={self.project_id} user_id={self.user_id} message={self.user_message}>"
 
 
+User.chat_session_count = column_property(
+    select(func.count(ChatSession.id)).where(ChatSession.user_id == User.id).scalar_subquery()
+)
+
+
 class ChatSessionCreatePost(SQLModel):
     project_id: Optional[str] = ""
     organization_id: Optional[str] = "pepe"
@@ -473,6 +658,8 @@ class ChatSessionCreatePost(SQLModel):
     node_limit: Optional[int] = LLM_MIN_NODE_LIMIT
     model: Optional[str] = LLM_MODELS.GPT_35_TURBO
     session_id: Optional[str] = ""
+    probes: Optional[int] = None
+    ef_search: Optional[int] = None
 
 
 class ChatSessionCreate(SQLModel):
@@ -553,12 +740,125 @@ class DocumentRead(SQLModel):
     node_count: int
     url: Optional[str]
     version: int
-    data: bytes
     hash: str
     created_at: datetime
     updated_at: datetime
 
 
+# ===============
+# Embedding cache
+# ===============
+class EmbeddingCache(BaseModel, table=True):
+    class Config:
+        arbitrary_types_allowed = True
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    query_hash: str = Field(nullable=False)  # sha256 of the normalized query
+    model: str = Field(nullable=False)
+    embeddings: Optional[List[float]] = Field(
+        sa_column=Column(Vector(VECTOR_EMBEDDINGS_COUNT))
+    )
+    created_at: datetime = Field(default_factory=datetime.now)
+
+    __table_args__ = (
+        UniqueConstraint("query_hash", "model", name="unq_embedding_cache_hash_model"),
+    )
+
+    def __repr__(self):
+        return f"<EmbeddingCache id={self.id} model={self.model} query_hash={self.query_hash}>"
+
+
+# ==============
+# Response cache
+# ==============
+class ResponseCache(BaseModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    cache_key: str = Field(nullable=False)  # sha256 of query, node ids, model, temperature
+    node_ids: List[int] = Field(sa_column=Column(ARRAY(Integer), nullable=False))
+    model: str = Field(nullable=False)
+    temperature: float = Field(nullable=False)
+    response: Dict[str, Any] = Field(sa_column=Column(JSONB), default={})
+    created_at: datetime = Field(default_factory=datetime.now)
+
+    __table_args__ = (
+        UniqueConstraint("cache_key", name="unq_response_cache_key"),
+        # node_ids && ARRAY[...] lookups when nodes are deprecated
+        Index("ix_response_cache_node_ids", "node_ids", postgresql_using="gin"),
+    )
+
+    def __repr__(self):
+        return f"<ResponseCache id={self.id} model={self.model} cache_key={self.cache_key}>"
+
+
+# ===========
+# Ingest jobs
+# ===========
+class IngestJob(BaseModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    uuid: Optional[uuid_pkg.UUID] = Field(unique=True, default_factory=uuid_pkg.uuid4)
+    organization_id: int = Field(default=None, foreign_key="organization.id")
+    project_id: int = Field(default=None, foreign_key="project.id")
+    document_id: Optional[int] = Field(default=None, foreign_key="document.id")
+    file_path: str = Field(nullable=False)
+    file_hash: Optional[str] = Field(default=None)
+    url: Optional[str] = Field(default=None)
+    overwrite: bool = Field(default=True)
+    status: Optional[JOB_STATUS] = Field(default=JOB_STATUS.QUEUED.value)
+    attempts: int = Field(default=0)
+    max_attempts: int = Field(default=INGEST_MAX_ATTEMPTS)
+    progress_done: int = Field(default=0)
+    progress_total: Optional[int] = Field(default=None)
+    error: Optional[str] = Field(default=None)
+    worker_id: Optional[str] = Field(default=None)
+    run_after: Optional[datetime] = Field(default_factory=datetime.now)
+    heartbeat_at: Optional[datetime] = Field(default=None)
+    finished_at: Optional[datetime] = Field(default=None)
+    created_at: Optional[datetime] = Field(default_factory=datetime.now)
+    updated_at: Optional[datetime] = Field(default_factory=datetime.now)
+
+    # -------------
+    # Relationships
+    # -------------
+    document: Optional[Document] = Relationship()
+
+    @property
+    def file_name(self) -> str:
+        return os.path.basename(self.file_path)
+
+    @property
+    def document_uuid(self) -> Optional[uuid_pkg.UUID]:
+        return self.document.uuid if self.document else None
+
+    __table_args__ = (
+        # Workers claim the oldest due job that is queued
+        Index(
+            "ix_ingest_job_queued",
+            "run_after",
+            postgresql_where=text(f"status = {JOB_STATUS.QUEUED.value}"),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<IngestJob id={self.id} uuid={self.uuid} status={self.status}>"
+
+
+class IngestJobRead(SQLModel):
+    uuid: uuid_pkg.UUID
+    status: JOB_STATUS
+    file_name: str
+    url: Optional[str]
+    attempts: int
+    max_attempts: int
+    progress_done: int
+    progress_total: Optional[int]
+    error: Optional[str]
+    document_uuid: Optional[uuid_pkg.UUID]
+    run_after: Optional[datetime]
+    finished_at: Optional[datetime]
+    created_at: datetime
+    updated_at: datetime
+
+
 class WebhookCreate(SQLModel):
     update_id: str
     message: Dict[str, Any]
@@ -572,8 +872,116 @@ class WebhookResponse(SQLModel):
 # ==================
 # Database functions
 # ==================
-def get_engine(dsn: str = SU_DSN):
-    return create_engine(dsn)
+VECTOR_INDEX_LOCK_KEY = 7431  # pg advisory lock held while vector indexes build
+DOCUMENT_DATA_MIGRATION_BATCH_SIZE = 100  # document files moved per transaction by upgrade_db
+
+# -----------------------------------------------------------
+# Engine registry: one long-lived connection pool per DSN so
+# every query in the process reuses already-open connections
+# -----------------------------------------------------------
+_engines: Dict[str, Engine] = {}
+_async_engines: Dict[str, AsyncEngine] = {}
+_engines_lock = Lock()
+
+
+def _pool_options() -> Dict[str, Any]:
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+def _connection_settings() -> Dict[str, str]:
+    # Server settings applied once when each pooled connection is opened
+    settings = {}
+    if DB_STATEMENT_TIMEOUT:
+        settings["statement_timeout"] = str(DB_STATEMENT_TIMEOUT)
+    if PGVECTOR_IVFFLAT_PROBES:
+        settings["ivfflat.probes"] = str(int(PGVECTOR_IVFFLAT_PROBES))
+    if PGVECTOR_HNSW_EF_SEARCH:
+        settings["hnsw.ef_search"] = str(int(PGVECTOR_HNSW_EF_SEARCH))
+    if PGVECTOR_ITERATIVE_SCAN:
+        settings["ivfflat.iterative_scan"] = PGVECTOR_ITERATIVE_SCAN
+        settings["hnsw.iterative_scan"] = PGVECTOR_ITERATIVE_SCAN
+    return settings
+
+
+def get_engine(dsn: str = SU_DSN) -> Engine:
+    engine = _engines.get(dsn)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(dsn)
+            if engine is None:
+                settings = _connection_settings()
+                connect_args = (
+                    {"options": " ".join(f"-c {k}={v}" for k, v in settings.items())}
+                    if settings
+                    else {}
+                )
+                engine = create_engine(
+                    dsn, connect_args=connect_args, **_pool_options()
+                )
+                _engines[dsn] = engine
+                logger.debug(f"🔌 Created connection pool for {engine.url!r}")
+    return engine
+
+
+def get_async_engine(dsn: str = ASYNC_SU_DSN) -> AsyncEngine:
+    engine = _async_engines.get(dsn)
+    if engine is None:
+        with _engines_lock:
+            engine = _async_engines.get(dsn)
+            if engine is None:
+                settings = _connection_settings()
+                connect_args = {"server_settings": settings} if settings else {}
+                engine = create_async_engine(
+                    dsn, connect_args=connect_args, **_pool_options()
+                )
+                event.listen(engine.sync_engine, "connect", _register_vector)
+                _async_engines[dsn] = engine
+                logger.debug(f"🔌 Created async connection pool for {engine.url!r}")
+    return engine
+
+
+def _register_vector(dbapi_connection, connection_record):
+    # Send and receive vectors in pgvector's binary format on asyncpg connections
+    dbapi_connection.run_async(register_vector)
+
+
+def dispose_engines():
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+async def dispose_async_engines():
+    with _engines_lock:
+        engines = list(_async_engines.values())
+        _async_engines.clear()
+
+    for engine in engines:
+        await engine.dispose()
+
+
+def get_pool_stats() -> List[Dict[str, Any]]:
+    engines = [
+        *_engines.values(),
+        *(engine.sync_engine for engine in _async_engines.values()),
+    ]
+    return [
+        {
+            "dsn": repr(engine.url),
+            "size": engine.pool.size(),
+            "checked_in": engine.pool.checkedin(),
+            "checked_out": engine.pool.checkedout(),
+            "overflow": engine.pool.overflow(),
+        }
+        for engine in engines
+    ]
 
 
 def get_session():
@@ -581,12 +989,118 @@ def get_session():
         yield session
 
 
+async def get_async_session():
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+        yield session
+
+
 def create_db():
     logger.info("...Enabling pgvector and creating database tables")
     enable_vector()
     BaseModel.metadata.create_all(get_engine(dsn=SU_DSN))
+    upgrade_db()
+    # The search functions reference node's columns, so they come after the upgrade
+    add_vector_distance_fn(Session(get_engine(dsn=SU_DSN)))
     create_user_permissions()
-    create_vector_index()
+    # Vector indexes are built by ensure_vector_index() once nodes exist,
+    # an ivfflat index trained on an empty table has useless centroids
+
+
+# ---------------------------------------------------------
+# create_all() only creates missing tables, columns added to
+# existing tables are created and backfilled here
+# ---------------------------------------------------------
+def upgrade_db():
+    session = Session(get_engine(dsn=SU_DSN))
+
+    # Columns added to node after its table was first created: chunk_hash
+    # for embedding reuse, tenant columns denormalized for filtered search
+    session.execute(
+        "ALTER TABLE node ADD COLUMN IF NOT EXISTS project_id integer REFERENCES project (id);"
+    )
+    session.execute(
+        "ALTER TABLE node ADD COLUMN IF NOT EXISTS organization_id integer REFERENCES organization (id);"
+    )
+    session.execute("ALTER TABLE node ADD COLUMN IF NOT EXISTS chunk_hash varchar;")
+    session.execute(
+        """UPDATE node
+        SET project_id = document.project_id, organization_id = document.organization_id
+        FROM document
+        WHERE node.document_id = document.id
+        AND (node.project_id IS NULL OR node.organization_id IS NULL);"""
+    )
+    session.execute(
+        f"""CREATE INDEX IF NOT EXISTS ix_node_project_active ON node (project_id)
+        WHERE status = {ENTITY_STATUS.ACTIVE.value};"""
+    )
+    session.execute(
+        f"""CREATE INDEX IF NOT EXISTS ix_node_organization_active ON node (organization_id)
+        WHERE status = {ENTITY_STATUS.ACTIVE.value};"""
+    )
+
+    # create_all only builds indexes along with a new table, so indexes
+    # added to existing tables are created here
+    session.execute(
+        f"""CREATE INDEX IF NOT EXISTS ix_document_project_name_active
+        ON document (project_id, display_name)
+        WHERE status = {ENTITY_STATUS.ACTIVE.value};"""
+    )
+    session.execute(
+        """CREATE INDEX IF NOT EXISTS ix_chat_session_project_created_at
+        ON chat_session (project_id, created_at);"""
+    )
+    session.execute("CREATE INDEX IF NOT EXISTS ix_node_document_id ON node (document_id);")
+    session.execute("CREATE INDEX IF NOT EXISTS ix_document_project_id ON document (project_id);")
+    session.execute("CREATE INDEX IF NOT EXISTS ix_chat_session_user_id ON chat_session (user_id);")
+    session.commit()
+
+    # -----------------------------------------------------------
+    # Files used to live uncompressed in document.data. Move them
+    # to document_data in batches (compressed on the way through
+    # CompressedBytes), then drop the old column
+    # -----------------------------------------------------------
+    has_data_column = session.execute(
+        """SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+        AND table_name = 'document' AND column_name = 'data';"""
+    ).first()
+    if has_data_column:
+        while True:
+            rows = session.execute(
+                text(
+                    "SELECT id, data FROM document WHERE data IS NOT NULL ORDER BY id LIMIT :limit"
+                ),
+                {"limit": DOCUMENT_DATA_MIGRATION_BATCH_SIZE},
+            ).all()
+            if not rows:
+                break
+
+            session.execute(
+                pg_insert(DocumentData)
+                .values(
+                    [
+                        {
+                            "document_id": row.id,
+                            "data": bytes(row.data),
+                            "size": len(row.data),
+                            "created_at": datetime.now(),
+                        }
+                        for row in rows
+                    ]
+                )
+                .on_conflict_do_nothing(index_elements=["document_id"])
+            )
+            session.execute(
+                text("UPDATE document SET data = NULL WHERE id = ANY(:ids)"),
+                {"ids": [row.id for row in rows]},
+            )
+            session.commit()
+            logger.info(f"📦 Moved {len(rows)} document files to document_data")
+
+        session.execute("ALTER TABLE document DROP COLUMN data;")
+        session.commit()
+
+    session.close()
 
 
 def create_user_permissions():
@@ -602,15 +1116,240 @@ def drop_db():
     BaseModel.metadata.drop_all(get_engine(dsn=SU_DSN))
 
 
-def create_vector_index():
-    # -------------------------------------
-    # Let's add an index for the embeddings
-    # -------------------------------------
+def get_vector_index_name(
+    strategy: DISTANCE_STRATEGY, index_type: VECTOR_INDEX_TYPE
+) -> str:
+    return f"ix_node_embeddings_{strategy.strategy_name}_{index_type.value}"
+
+
+def get_ivfflat_lists(rows: int) -> int:
+    # pgvector's guidance: rows / 1000 up to 1M rows, sqrt(rows) beyond that
+    if PGVECTOR_IVFFLAT_LISTS:
+        return PGVECTOR_IVFFLAT_LISTS
+    return max(1, rows // 1000 if rows <= 1_000_000 else int(sqrt(rows)))
+
+
+def get_vector_index_sql(
+    strategy: DISTANCE_STRATEGY,
+    index_type: VECTOR_INDEX_TYPE = PGVECTOR_INDEX_TYPE,
+    lists: Optional[int] = None,
+    m: int = PGVECTOR_HNSW_M,
+    ef_construction: int = PGVECTOR_HNSW_EF_CONSTRUCTION,
+    name: Optional[str] = None,
+    concurrently: bool = False,
+    rows: int = 0,
+) -> str:
+    ops = next(s[3] for s in DISTANCE_STRATEGIES if s[0] == strategy)
+    params = (
+        f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+        if index_type == VECTOR_INDEX_TYPE.HNSW
+        else f"lists = {int(lists or get_ivfflat_lists(rows))}"
+    )
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+        f"{name or get_vector_index_name(strategy, index_type)} "
+        f"ON node USING {index_type.value} (embeddings {ops}) WITH ({params});"
+    )
+
+
+def get_vector_index_rows(session: Session) -> int:
+    return session.exec(
+        select(func.count(Node.id)).where(Node.status == ENTITY_STATUS.ACTIVE.value)
+    ).one()
+
+
+def set_vector_index_rows(conn, name: str, rows: int):
+    # The rebuild check compares against the row count kept in the index comment
+    conn.execute(text(f"COMMENT ON INDEX {name} IS 'rows={int(rows)}'"))
+
+
+def get_vector_index_status() -> Dict[str, Any]:
+    with Session(get_engine(dsn=SU_DSN)) as session:
+        rows = get_vector_index_rows(session)
+        indexes = session.execute(
+            text(
+                """SELECT
+    c.relname AS name,
+    i.indisvalid AS valid,
+    obj_description(c.oid, 'pg_class') AS comment,
+    pg_relation_size(c.oid) AS size_bytes
+FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = 'node'::regclass
+    AND c.relname LIKE 'ix_node_embeddings_%'"""
+            )
+        ).all()
+        is_building = not session.execute(
+            text("SELECT pg_try_advisory_lock_shared(:key)"),
+            {"key": VECTOR_INDEX_LOCK_KEY},
+        ).scalar()
+        if not is_building:
+            session.execute(
+                text("SELECT pg_advisory_unlock_shared(:key)"),
+                {"key": VECTOR_INDEX_LOCK_KEY},
+            )
+
+    built = {
+        index.name: {
+            "name": index.name,
+            "valid": index.valid,
+            # Row count at build time is kept in the index comment
+            "built_rows": int(index.comment.split("=")[1])
+            if index.comment and index.comment.startswith("rows=")
+            else None,
+            "size_bytes": index.size_bytes,
+        }
+        for index in indexes
+    }
+
+    status = []
+    for strategy in PGVECTOR_INDEX_STRATEGIES:
+        name = get_vector_index_name(strategy, PGVECTOR_INDEX_TYPE)
+        index = built.get(name)
+        if rows < PGVECTOR_INDEX_MIN_ROWS:
+            action = None
+        elif not index or not index["valid"]:
+            action = "build"
+        elif (
+            PGVECTOR_INDEX_TYPE == VECTOR_INDEX_TYPE.IVFFLAT
+            and index["built_rows"] is not None
+            and rows >= index["built_rows"] * PGVECTOR_INDEX_REBUILD_FACTOR
+        ):
+            # ivfflat centroids are trained at build time and go stale as data grows
+            action = "rebuild"
+        else:
+            action = None
+
+        status.append(
+            {"strategy": strategy.strategy_name, "index": index, "action": action}
+        )
+
+    return {
+        "enabled": PGVECTOR_ADD_INDEX,
+        "index_type": PGVECTOR_INDEX_TYPE.value,
+        "rows": rows,
+        "min_rows": PGVECTOR_INDEX_MIN_ROWS,
+        "is_building": is_building,
+        "strategies": status,
+    }
+
+
+def build_vector_index(
+    strategy: DISTANCE_STRATEGY,
+    rows: int,
+    index_type: VECTOR_INDEX_TYPE = PGVECTOR_INDEX_TYPE,
+):
+    # -------------------------------------------------------------
+    # Build the index CONCURRENTLY under a temporary name so ingest
+    # never blocks, then swap it in for the old one in one transaction
+    # -------------------------------------------------------------
+    name = get_vector_index_name(strategy, index_type)
+    lists = get_ivfflat_lists(rows)
+    engine = get_engine(dsn=SU_DSN)
+    logger.info(f"🏗️  Building {name} over {rows} nodes (lists={lists})")
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # Session level, so it has to be undone before the connection goes back to the pool
+        conn.execute(text("SET statement_timeout = 0"))
+        try:
+            # An interrupted CONCURRENTLY build leaves an invalid index behind
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}_new"))
+            conn.execute(
+                text(
+                    get_vector_index_sql(
+                        strategy, index_type, lists=lists, name=f"{name}_new", concurrently=True
+                    )
+                )
+            )
+        finally:
+            conn.execute(text("RESET statement_timeout"))
+
+    # ----------------------------------------------------------
+    # DROP INDEX takes an ACCESS EXCLUSIVE lock on node. Waiting
+    # for it behind a long query would queue every query behind
+    # us, so give up quickly and try again a little later
+    # ----------------------------------------------------------
+    for attempt in range(1, PGVECTOR_INDEX_SWAP_RETRIES + 1):
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    text(f"SET LOCAL lock_timeout = {int(PGVECTOR_INDEX_SWAP_LOCK_TIMEOUT)}")
+                )
+                conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+                conn.execute(text(f"ALTER INDEX {name}_new RENAME TO {name}"))
+                set_vector_index_rows(conn, name, rows)
+            return
+        except OperationalError as e:
+            if attempt == PGVECTOR_INDEX_SWAP_RETRIES:
+                raise
+            logger.warning(f"🏗️  Couldn't lock node to swap in {name}, retrying: {e.orig}")
+            time.sleep(attempt)
+
+
+def ensure_vector_index(force: bool = False) -> Dict[str, Any]:
+    # --------------------------------------------------------------
+    # Build or retrain the vector indexes once the data justifies it.
+    # Safe to call after every ingest: only one process builds at a time
+    # --------------------------------------------------------------
+    if PGVECTOR_ADD_INDEX is not True:
+        return get_vector_index_status()
+
+    engine = get_engine(dsn=SU_DSN)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": VECTOR_INDEX_LOCK_KEY}
+        ).scalar():
+            logger.debug("🏗️  Vector index build already running elsewhere")
+            return get_vector_index_status()
+
+        try:
+            # Fresh planner statistics after bulk loads
+            conn.execute(text("ANALYZE node"))
+            status = get_vector_index_status()
+
+            for strategy in PGVECTOR_INDEX_STRATEGIES:
+                action, index = next(
+                    (s["action"], s["index"])
+                    for s in status["strategies"]
+                    if s["strategy"] == strategy.strategy_name
+                )
+                if action or (force and status["rows"] > 0):
+                    build_vector_index(strategy, status["rows"])
+                elif index and index["valid"] and index["built_rows"] is None:
+                    # Built outside of here (create_vector_index, by hand), so
+                    # take the current size as its baseline instead of rebuilding
+                    set_vector_index_rows(conn, index["name"], status["rows"])
+        finally:
+            conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": VECTOR_INDEX_LOCK_KEY}
+            )
+
+    return get_vector_index_status()
+
+
+def create_vector_index(
+    index_type: VECTOR_INDEX_TYPE = PGVECTOR_INDEX_TYPE,
+    strategies: List[DISTANCE_STRATEGY] = PGVECTOR_INDEX_STRATEGIES,
+    lists: Optional[int] = None,
+    m: int = PGVECTOR_HNSW_M,
+    ef_construction: int = PGVECTOR_HNSW_EF_CONSTRUCTION,
+):
+    # ------------------------------------------------------
+    # Let's add an index for the embeddings, one per distance
+    # strategy in use (every extra index slows down ingest).
+    # Prefer ensure_vector_index(), which waits for data first
+    # ------------------------------------------------------
     if PGVECTOR_ADD_INDEX is True:
         session = Session(get_engine(dsn=SU_DSN))
-        for strategy in DISTANCE_STRATEGIES:
-            session.execute(strategy[3])
+        rows = get_vector_index_rows(session)
+        for strategy in strategies:
+            session.execute(
+                get_vector_index_sql(
+                    strategy, index_type, lists, m, ef_construction, rows=rows
+                )
+            )
             session.commit()
+        session.close()
 
 
 def enable_vector():
@@ -618,7 +1357,6 @@ def enable_vector():
     query = "CREATE EXTENSION IF NOT EXISTS vector;"
     session.execute(query)
     session.commit()
-    add_vector_distance_fn(session)
     session.close()
 
 
@@ -627,28 +1365,95 @@ def add_vector_distance_fn(session: Session):
         strategy_name = strategy[1]
         strategy_distance_str = strategy[2]
 
+        # The signature changes between releases, which "create or replace" can't do
+        session.execute(
+            f"drop function if exists match_node_{strategy_name} (vector, float, int);"
+        )
+        session.execute(
+            f"drop function if exists match_node_{strategy_name} (vector, float, int, int, int);"
+        )
+
         query = f"""create or replace function match_node_{strategy_name} (
     query_embeddings vector({VECTOR_EMBEDDINGS_COUNT}),
     match_threshold float,
-    match_count int
+    match_count int,
+    filter_project_id int default null,
+    filter_organization_id int default null
 ) returns table (
+    id int,
     uuid uuid,
     text varchar,
-    similarity float
+    token_count int,
+    similarity float,
+    document_id int,
+    project_id int,
+    organization_id int
 )
-language plpgsql
+language sql stable
 as $$
-begin
-    return query
-    select
-        node.uuid,
-        node.text,
-        1 - (node.embeddings {strategy_distance_str} query_embeddings) as similarity
-    from node
-        where 1 - (node.embeddings {strategy_distance_str} query_embeddings) > match_threshold
-        order by similarity desc
-        limit match_count;
-end;
+    -- The ANN index hands back its nearest candidates from the whole table
+    -- before the tenant filter runs, so a small tenant in a big table would
+    -- get few rows or none. Tenants up to the exact scan limit are ranked
+    -- exactly instead; the count stops at the limit, so it stays cheap
+    with tenant as (
+        select (filter_project_id is not null or filter_organization_id is not null)
+            and count(*) <= {PGVECTOR_EXACT_SCAN_MAX_ROWS} as is_small
+        from (
+            select 1 from node
+                where (filter_project_id is not null or filter_organization_id is not null)
+                and node.status = {ENTITY_STATUS.ACTIVE.value}
+                and (filter_project_id is null or node.project_id = filter_project_id)
+                and (filter_organization_id is null or node.organization_id = filter_organization_id)
+                limit {PGVECTOR_EXACT_SCAN_MAX_ROWS + 1}
+        ) as tenant_rows
+    )
+    -- Nearest neighbours first (ORDER BY distance LIMIT k is the shape
+    -- pgvector's indexes can serve), then drop the ones below threshold
+    select * from (
+        (
+            select
+                tenant_nodes.id,
+                tenant_nodes.uuid,
+                tenant_nodes.text,
+                tenant_nodes.token_count,
+                1 - (tenant_nodes.embeddings {strategy_distance_str} query_embeddings) as similarity,
+                tenant_nodes.document_id,
+                tenant_nodes.project_id,
+                tenant_nodes.organization_id
+            from (
+                -- offset 0 keeps the ORDER BY below from being served by the ANN index
+                select * from node
+                    where (select is_small from tenant)
+                    and node.status = {ENTITY_STATUS.ACTIVE.value}
+                    and (filter_project_id is null or node.project_id = filter_project_id)
+                    and (filter_organization_id is null or node.organization_id = filter_organization_id)
+                    offset 0
+            ) as tenant_nodes
+                order by tenant_nodes.embeddings {strategy_distance_str} query_embeddings
+                limit match_count
+        )
+        union all
+        (
+            select
+                node.id,
+                node.uuid,
+                node.text,
+                node.token_count,
+                1 - (node.embeddings {strategy_distance_str} query_embeddings) as similarity,
+                node.document_id,
+                node.project_id,
+                node.organization_id
+            from node
+                where not (select is_small from tenant)
+                and node.status = {ENTITY_STATUS.ACTIVE.value}
+                and (filter_project_id is null or node.project_id = filter_project_id)
+                and (filter_organization_id is null or node.organization_id = filter_organization_id)
+                order by node.embeddings {strategy_distance_str} query_embeddings
+                limit match_count
+        )
+    ) as nearest
+        where nearest.similarity > match_threshold
+        order by nearest.similarity desc;
 $$;"""
 
         session.execute(query)
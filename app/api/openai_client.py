@@ -0,0 +1,343 @@
+'''
+openai_client.py is the one HTTP client the API uses to talk to OpenAI.
+Connections are pooled and kept alive, failed calls are retried with jittered
+exponential backoff, in-flight calls are capped globally and per model, and a
+circuit breaker fails fast while the upstream keeps erroring.
+'''
+from threading import BoundedSemaphore, Lock
+from collections import defaultdict
+from typing import (
+    AsyncIterator,
+    Optional,
+    List,
+    Dict,
+    Any
+)
+import asyncio
+import random
+import httpx
+import json
+import time
+
+from metrics import increment
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_API_BASE,
+    OPENAI_TIMEOUT,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_RETRIES,
+    OPENAI_RETRY_BACKOFF,
+    OPENAI_RETRY_MAX_BACKOFF,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_MODEL_CONCURRENCY,
+    OPENAI_BREAKER_THRESHOLD,
+    OPENAI_BREAKER_COOLDOWN,
+    logger
+)
+
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class OpenAIError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(OpenAIError):
+    pass
+
+
+# -------------------------------------------------------
+# Circuit breaker: opens after THRESHOLD failed calls in a
+# row, then lets a single trial call through per COOLDOWN.
+# Only 5xx and transport errors count as failures, any
+# other response shows the upstream is answering
+# -------------------------------------------------------
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.cooldown else 'open'
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown:
+                increment('openai.circuit_rejected')
+                raise CircuitOpenError('OpenAI circuit breaker is open', status_code=503)
+            # Half-open: this call is the trial, push the window out for everyone else
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(f'🚨 OpenAI circuit breaker open after {self.failures} failures')
+                    increment('openai.circuit_opened')
+                self.opened_at = time.monotonic()
+
+
+# ------------------------
+# Shared OpenAI API client
+# ------------------------
+class OpenAIClient:
+    def __init__(
+        self,
+        api_key: Optional[str] = OPENAI_API_KEY,
+        api_base: str = OPENAI_API_BASE,
+        timeout: float = OPENAI_TIMEOUT,
+        max_connections: int = OPENAI_MAX_CONNECTIONS,
+        max_retries: int = OPENAI_MAX_RETRIES,
+        max_concurrency: int = OPENAI_MAX_CONCURRENCY,
+        model_concurrency: int = OPENAI_MODEL_CONCURRENCY,
+    ):
+        self.api_base = api_base.rstrip('/')
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = model_concurrency
+        self.breaker = CircuitBreaker(OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN)
+
+        self._client_options = {
+            'base_url': self.api_base,
+            'headers': {'Authorization': f'Bearer {api_key}'},
+            'timeout': httpx.Timeout(timeout, connect=min(timeout, 10.0)),
+            'limits': httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        }
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sync_client: Optional[httpx.Client] = None
+        self._lock = Lock()
+
+        # asyncio semaphores bind to the running loop, so they are created on first use.
+        # The blocking methods have their own pool of the same size: the caps apply
+        # to async and sync calls separately, up to twice the limit combined
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._model_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._sync_semaphore = BoundedSemaphore(max_concurrency)
+        self._sync_model_semaphores = defaultdict(lambda: BoundedSemaphore(model_concurrency))
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(**self._client_options)
+        return self._client
+
+    @property
+    def sync_client(self) -> httpx.Client:
+        with self._lock:
+            if self._sync_client is None:
+                self._sync_client = httpx.Client(**self._client_options)
+            return self._sync_client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+    # --------------------------
+    # Concurrency and retry policy
+    # --------------------------
+    def _get_semaphores(self, model: str):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if model not in self._model_semaphores:
+            self._model_semaphores[model] = asyncio.Semaphore(self.model_concurrency)
+        return self._semaphore, self._model_semaphores[model]
+
+    def _get_backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        # Honour Retry-After from a 429/503, otherwise full jitter exponential backoff
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), OPENAI_RETRY_MAX_BACKOFF)
+            except ValueError:
+                pass
+        return random.uniform(0, min(OPENAI_RETRY_MAX_BACKOFF, OPENAI_RETRY_BACKOFF * 2 ** attempt))
+
+    def _should_retry(self, attempt: int, error: Exception) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            retryable = error.response.status_code in RETRY_STATUS_CODES
+        else:
+            retryable = isinstance(error, httpx.TransportError)
+
+        if retryable:
+            increment('openai.retryable_error')
+        return retryable and attempt < self.max_retries
+
+    def _fail(self, error: Exception):
+        # One breaker outcome per call, once it has run out of retries
+        if isinstance(error, httpx.HTTPStatusError) and error.response.status_code < 500:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        self._raise_error(error)
+
+    def _raise_error(self, error: Exception):
+        if isinstance(error, httpx.HTTPStatusError):
+            try:
+                message = error.response.json()['error']['message']
+            except (ValueError, KeyError, TypeError):
+                message = error.response.text
+            raise OpenAIError(
+                f'OpenAI API error {error.response.status_code}: {message}',
+                status_code=error.response.status_code,
+            ) from error
+        raise OpenAIError(f'OpenAI API request failed: {error!r}') from error
+
+    async def request(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        model = payload.get('model', '')
+        semaphore, model_semaphore = self._get_semaphores(model)
+
+        self.breaker.before_call()
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                async with semaphore, model_semaphore:
+                    response = await self.client.post(path, json=payload)
+                    response.raise_for_status()
+                self.breaker.record_success()
+                increment('openai.request')
+                return response.json()
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                if not self._should_retry(attempt, e):
+                    self._fail(e)
+                backoff = self._get_backoff(attempt, response)
+                logger.debug(f'🔁 OpenAI {path} failed ({e!r}), retrying in {backoff:.2f}s')
+                await asyncio.sleep(backoff)
+
+    def request_sync(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        # Blocking twin of request() for ingestion code running in threads
+        model = payload.get('model', '')
+
+        self.breaker.before_call()
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                with self._sync_semaphore, self._sync_model_semaphores[model]:
+                    response = self.sync_client.post(path, json=payload)
+                    response.raise_for_status()
+                self.breaker.record_success()
+                increment('openai.request')
+                return response.json()
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                if not self._should_retry(attempt, e):
+                    self._fail(e)
+                backoff = self._get_backoff(attempt, response)
+                logger.debug(f'🔁 OpenAI {path} failed ({e!r}), retrying in {backoff:.2f}s')
+                time.sleep(backoff)
+
+    async def stream(self, path: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        # Retries only happen before the first event, a half-sent answer can't be replayed
+        model = payload.get('model', '')
+        semaphore, model_semaphore = self._get_semaphores(model)
+        payload = {**payload, 'stream': True}
+
+        started = False
+        self.breaker.before_call()
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                async with semaphore, model_semaphore:
+                    async with self.client.stream('POST', path, json=payload) as response:
+                        if response.is_error:
+                            await response.aread()
+                        response.raise_for_status()
+                        self.breaker.record_success()
+                        increment('openai.request')
+
+                        async for line in response.aiter_lines():
+                            if not line.startswith('data:'):
+                                continue
+                            data = line[len('data:'):].strip()
+                            if data == '[DONE]':
+                                return
+                            try:
+                                event = json.loads(data)
+                            except ValueError as e:
+                                raise OpenAIError(f'Malformed OpenAI stream event: {data[:200]!r}') from e
+                            started = True
+                            yield event
+                return
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                if started or not self._should_retry(attempt, e):
+                    self._fail(e)
+                backoff = self._get_backoff(attempt, response)
+                logger.debug(f'🔁 OpenAI {path} stream failed ({e!r}), retrying in {backoff:.2f}s')
+                await asyncio.sleep(backoff)
+
+    # ---------
+    # Endpoints
+    # ---------
+    async def embeddings(self, texts: List[str], model: str) -> List[List[float]]:
+        response = await self.request('/embeddings', {'model': model, 'input': texts})
+        return [row['embedding'] for row in sorted(response['data'], key=lambda row: row['index'])]
+
+    def embeddings_sync(self, texts: List[str], model: str) -> List[List[float]]:
+        response = self.request_sync('/embeddings', {'model': model, 'input': texts})
+        return [row['embedding'] for row in sorted(response['data'], key=lambda row: row['index'])]
+
+    async def chat_completion(self, messages: List[Dict[str, str]], model: str, **params) -> str:
+        response = await self.request('/chat/completions', {'model': model, 'messages': messages, **params})
+        return response['choices'][0]['message']['content']
+
+    async def completion(self, prompt: str, model: str, **params) -> str:
+        response = await self.request('/completions', {'model': model, 'prompt': prompt, **params})
+        return response['choices'][0]['text']
+
+    async def stream_chat_completion(
+        self, messages: List[Dict[str, str]], model: str, **params
+    ) -> AsyncIterator[str]:
+        async for chunk in self.stream('/chat/completions', {'model': model, 'messages': messages, **params}):
+            text = chunk['choices'][0].get('delta', {}).get('content')
+            if text:
+                yield text
+
+    async def stream_completion(self, prompt: str, model: str, **params) -> AsyncIterator[str]:
+        async for chunk in self.stream('/completions', {'model': model, 'prompt': prompt, **params}):
+            text = chunk['choices'][0].get('text')
+            if text:
+                yield text
+
+
+# -------------------------
+# Process-wide shared client
+# -------------------------
+_openai_client: Optional[OpenAIClient] = None
+_openai_client_lock = Lock()
+
+
+def get_openai_client() -> OpenAIClient:
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = OpenAIClient()
+        return _openai_client
+
+
+async def close_openai_client():
+    global _openai_client
+    with _openai_client_lock:
+        client, _openai_client = _openai_client, None
+    if client is not None:
+        await client.aclose()
@@ -17,6 +17,9 @@ from config import (
 from util import (
     get_file_hash
 )
+from models import (
+    ensure_vector_index
+)
 import os
 
 # --------------------
@@ -167,4 +170,10 @@ for org in organizations:
                 )
                 logger.info(f'  ✅  Created document: {doc}')
             else:
-                logger.error(f' ❌  Document not found: {doc}')
\ No newline at end of file
+                logger.error(f' ❌  Document not found: {doc}')
+
+# ----------------------------------------
+# Index the seeded nodes now that they exist
+# ----------------------------------------
+ensure_vector_index()
+logger.info('🏗️  Vector index status checked')
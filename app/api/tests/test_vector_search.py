@@ -0,0 +1,102 @@
+'''
+Vector search against a real Postgres with pgvector (run `make install` first).
+Everything is written inside one transaction that is rolled back at the end.
+
+    cd app/api && python3 -m pytest tests
+'''
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+sqlalchemy = pytest.importorskip('sqlalchemy')
+pytest.importorskip('psycopg2')
+pytest.importorskip('pgvector')
+# The API's own modules pull in the full requirements.txt
+llm = pytest.importorskip('llm')
+models = pytest.importorskip('models')
+
+from sqlmodel import Session  # noqa: E402
+from config import (  # noqa: E402
+    DISTANCE_STRATEGY,
+    VECTOR_EMBEDDINGS_COUNT,
+    SU_DSN
+)
+
+LARGE_PROJECT_NODES = 2000
+SMALL_PROJECT_NODES = 5
+
+
+def random_embeddings():
+    return [random.uniform(-1, 1) for _ in range(VECTOR_EMBEDDINGS_COUNT)]
+
+
+@pytest.fixture
+def session():
+    try:
+        connection = models.get_engine(dsn=SU_DSN).connect()
+    except sqlalchemy.exc.OperationalError as e:
+        pytest.skip(f'Postgres is not reachable: {e}')
+
+    transaction = connection.begin()
+    with Session(bind=connection) as session:
+        yield session
+    transaction.rollback()
+    connection.close()
+
+
+def add_project(session: Session, organization, name: str, nodes: int):
+    project = models.Project(organization_id=organization.id, display_name=name)
+    session.add(project)
+    session.flush()
+
+    document = models.Document(
+        organization_id=organization.id,
+        project_id=project.id,
+        display_name=f'{name}.md',
+        hash=f'{name}-{random.random()}',
+    )
+    session.add(document)
+    session.flush()
+
+    session.add_all([
+        models.Node(
+            document_id=document.id,
+            project_id=project.id,
+            organization_id=organization.id,
+            embeddings=random_embeddings(),
+            text=f'{name} chunk {i}',
+            token_count=3,
+        )
+        for i in range(nodes)
+    ])
+    session.flush()
+    return project
+
+
+def test_small_project_next_to_large_project_gets_k_rows(session):
+    organization = models.Organization(namespace=f'test-{random.random()}', display_name='test')
+    session.add(organization)
+    session.flush()
+
+    add_project(session, organization, 'large', LARGE_PROJECT_NODES)
+    small = add_project(session, organization, 'small', SMALL_PROJECT_NODES)
+
+    # An ANN index over both tenants, and no way around it for the planner
+    session.execute(
+        'CREATE INDEX ix_test_node_embeddings ON node '
+        'USING ivfflat (embeddings vector_l2_ops) WITH (lists = 20)'
+    )
+    session.execute('SET LOCAL enable_seqscan = off')
+
+    k = 3
+    rows = session.execute(
+        llm.get_match_nodes_query(DISTANCE_STRATEGY.EUCLIDEAN),
+        llm.get_match_nodes_params(random_embeddings(), k, float('-inf'), project_id=small.id),
+    ).all()
+
+    assert len(rows) == k
+    assert {row.project_id for row in rows} == {small.id}
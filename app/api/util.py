@@ -1,11 +1,19 @@
-from fastapi import UploadFile
+from fastapi import HTTPException, UploadFile
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from typing import AsyncIterator, Optional, Tuple, List, Set, Type, Any
+from pydantic import BaseModel
 from functools import partial
 from hashlib import sha256
 from uuid import UUID
 import aiofiles
+import base64
 import json
+import os
 import re
 from config import (
+    FILE_UPLOAD_MAX_SIZE,
+    FILE_UPLOAD_CHUNK_SIZE,
     logger
 )
 
@@ -28,12 +36,100 @@ def is_uuid(uuid: str) -> bool:
     return re.match(r"^[0-9a-f]{8}-?[0-9a-f]{4}-?4[0-9a-f]{3}-?[89ab][0-9a-f]{3}-?[0-9a-f]{12}$", uuid)
 
 
+# ---------------------------------------------------------
+# Writes a stream of chunks to disk async, hashing as it
+# goes. Returns (size, sha256); past max_size the partial
+# file is removed and the upload rejected with a 413
+# ---------------------------------------------------------
+async def save_stream(
+    chunks: AsyncIterator[bytes],
+    file_path: str,
+    max_size: int = FILE_UPLOAD_MAX_SIZE,
+) -> Tuple[int, str]:
+    digest = sha256()
+    size = 0
+
+    try:
+        async with aiofiles.open(file_path, 'wb') as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise HTTPException(
+                        status_code=413, detail=f'File is larger than the {max_size} byte limit'
+                    )
+                digest.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+
+    return size, digest.hexdigest()
+
+
+async def iter_upload_file(file: UploadFile, chunk_size: int = FILE_UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
 # ---------------------------
 # Writes a file to disk async
 # ---------------------------
-async def save_file(file: UploadFile, file_path: str):
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(await file.read())
+async def save_file(file: UploadFile, file_path: str) -> Tuple[int, str]:
+    return await save_stream(iter_upload_file(file), file_path)
+
+
+# ----------------------------------------------------------
+# Opaque keyset pagination cursors, wrapping the last row id
+# ----------------------------------------------------------
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    if not cursor:
+        return None
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f'Invalid cursor {cursor}')
+
+
+# ------------------------------------------------------
+# Parse a sparse fieldset (?fields=uuid,display_name)
+# against the fields a response model actually exposes
+# ------------------------------------------------------
+def parse_fields(fields: Optional[str], model: Type[BaseModel]) -> Optional[Set[str]]:
+    if not fields:
+        return None
+
+    field_set = {field.strip() for field in fields.split(',') if field.strip()}
+    unknown = field_set - set(model.__fields__)
+    if unknown:
+        raise HTTPException(
+            status_code=422, detail=f'Unknown fields {", ".join(sorted(unknown))}'
+        )
+
+    return field_set
+
+
+# --------------------------------------------------------
+# Serialize one page of a list endpoint: only the requested
+# fields, with the next page's cursor in X-Next-Cursor
+# --------------------------------------------------------
+def get_page_response(
+    items: List[Any],
+    next_cursor: Optional[str],
+    model: Type[BaseModel],
+    fields: Optional[Set[str]] = None,
+) -> JSONResponse:
+    return JSONResponse(
+        content=jsonable_encoder([model.from_orm(item) for item in items], include=fields),
+        headers={'X-Next-Cursor': next_cursor} if next_cursor else None,
+    )
 
 
 # ---------------------------
@@ -49,10 +145,12 @@ def get_sha256(contents: bytes):
 def get_file_hash(
         file_path: str,
 ):
+    digest = sha256()
     with open(file_path, 'rb') as f:
-        file_hash = sha256(f.read()).hexdigest()
+        for chunk in iter(partial(f.read, FILE_UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
 
-    return file_hash
+    return digest.hexdigest()
 
 
 # -------------------
@@ -93,3 +191,80 @@ def sanitize_input(
     logger.debug(f'Input: {str_input}')
     return str_input
 
+
+# ---------------------------
+# Format a Server-Sent Event
+# ---------------------------
+def format_sse(event: str, data: dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
+
+
+# -------------------------------------------------------
+# Incrementally decode one string field of a streamed JSON
+# object, e.g. "message" while the LLM is still writing it
+# -------------------------------------------------------
+_json_escapes = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class JSONStringFieldParser:
+    def __init__(self, field: str = 'message'):
+        self._key = f'"{field}"'
+        self._buffer = ''
+        self._pos = 0
+        self._state = 'key'  # key -> colon -> value -> done
+
+    @property
+    def done(self) -> bool:
+        return self._state == 'done'
+
+    @property
+    def text(self) -> str:
+        return self._buffer
+
+    def feed(self, chunk: str) -> str:
+        '''Add raw LLM output, return the newly decoded part of the field'''
+        self._buffer += chunk
+        buf, i, out = self._buffer, self._pos, []
+
+        while i < len(buf) and self._state != 'done':
+            if self._state == 'key':
+                found = buf.find(self._key, i)
+                if found == -1:
+                    # Keep a partial key at the end of the buffer for the next chunk
+                    i = max(i, len(buf) - len(self._key) + 1)
+                    break
+                i = found + len(self._key)
+                self._state = 'colon'
+            elif self._state == 'colon':
+                if buf[i].isspace() or buf[i] == ':':
+                    i += 1
+                elif buf[i] == '"':
+                    i += 1
+                    self._state = 'value'
+                else:
+                    # The key text appeared as a value, keep looking
+                    self._state = 'key'
+            elif buf[i] == '"':
+                i += 1
+                self._state = 'done'
+            elif buf[i] == '\\':
+                if i + 1 >= len(buf):
+                    break
+                if buf[i + 1] != 'u':
+                    out.append(_json_escapes.get(buf[i + 1], buf[i + 1]))
+                    i += 2
+                    continue
+                # \uXXXX, or a \uXXXX\uXXXX surrogate pair
+                if i + 6 > len(buf):
+                    break
+                size = 12 if 0xD800 <= int(buf[i + 2:i + 6], 16) <= 0xDBFF else 6
+                if i + size > len(buf):
+                    break
+                out.append(json.loads(f'"{buf[i:i + size]}"'))
+                i += size
+            else:
+                out.append(buf[i])
+                i += 1
+
+        self._pos = i
+        return ''.join(out)
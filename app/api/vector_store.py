@@ -0,0 +1,269 @@
+'''
+vector_store.py keeps hot projects' node embeddings in memory and answers
+top-k searches with vectorized NumPy math instead of a round trip to pgvector.
+Postgres stays the source of truth: indexes load from it lazily and are
+patched in place by ingest and deprecation in this process. Within
+LLM_MEMORY_INDEX_TTL seconds a loaded index is searched without touching the
+database; after that, Project.updated_at (bumped by every change, in whichever
+process it ran) decides whether it is reloaded or kept for another TTL.
+'''
+from sqlmodel.ext.asyncio.session import AsyncSession
+from datetime import datetime
+from threading import Lock, RLock
+from sqlmodel import (
+    Session,
+    select
+)
+from typing import (
+    Iterable,
+    Optional,
+    List,
+    Dict
+)
+import numpy as np
+import asyncio
+import time
+
+from models import (
+    Node,
+    Project,
+    NodeReadResult,
+    get_engine
+)
+from config import (
+    DISTANCE_STRATEGY,
+    ENTITY_STATUS,
+    LLM_RETRIEVAL_BACKEND,
+    LLM_MEMORY_INDEX_PROJECTS,
+    LLM_MEMORY_INDEX_TTL,
+    RETRIEVAL_BACKEND,
+    VECTOR_EMBEDDINGS_COUNT,
+    logger
+)
+
+NODE_COLUMNS = (
+    Node.id,
+    Node.uuid,
+    Node.text,
+    Node.token_count,
+    Node.document_id,
+    Node.project_id,
+    Node.organization_id,
+    Node.embeddings,
+)
+
+
+# =====================
+# Project vector index
+# =====================
+class ProjectVectorIndex:
+    def __init__(self, project_id: int, version: Optional[datetime] = None):
+        self.project_id = project_id
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self._lock = RLock()
+        self._rows: List[dict] = []
+        self._document_ids = np.empty(0, dtype=np.int64)
+        self._matrix = np.empty((0, VECTOR_EMBEDDINGS_COUNT), dtype=np.float32)
+        self._norms = np.empty(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.loaded_at <= LLM_MEMORY_INDEX_TTL
+
+    def renew(self):
+        self.loaded_at = time.monotonic()
+
+    def add(self, nodes: Iterable):
+        nodes = [node for node in nodes if node.embeddings is not None]
+        if not nodes:
+            return
+
+        vectors = np.asarray([node.embeddings for node in nodes], dtype=np.float32)
+        rows = [
+            {
+                "id": node.id,
+                "uuid": node.uuid,
+                "text": node.text,
+                "token_count": node.token_count,
+                "document_id": node.document_id,
+                "project_id": node.project_id,
+                "organization_id": node.organization_id,
+            }
+            for node in nodes
+        ]
+
+        with self._lock:
+            self._rows = self._rows + rows
+            self._document_ids = np.concatenate(
+                [self._document_ids, [node.document_id for node in nodes]]
+            )
+            self._matrix = np.vstack([self._matrix, vectors])
+            self._norms = np.concatenate(
+                [self._norms, np.linalg.norm(vectors, axis=1)]
+            )
+
+    def remove_document(self, document_id: int):
+        with self._lock:
+            keep = self._document_ids != document_id
+            self._rows = [row for row, k in zip(self._rows, keep) if k]
+            self._document_ids = self._document_ids[keep]
+            self._matrix = self._matrix[keep]
+            self._norms = self._norms[keep]
+
+    def search(
+        self,
+        embeddings: List[float],
+        k: int,
+        distance_strategy: DISTANCE_STRATEGY,
+        distance_threshold: float,
+    ) -> List[NodeReadResult]:
+        # Snapshot the arrays, writers swap them rather than mutate in place
+        with self._lock:
+            rows, matrix, norms = self._rows, self._matrix, self._norms
+
+        if not rows:
+            return []
+
+        query = np.asarray(embeddings, dtype=np.float32)
+
+        # Same distance definitions as pgvector's <->, <=> and <#> operators
+        if distance_strategy == DISTANCE_STRATEGY.EUCLIDEAN:
+            distances = np.linalg.norm(matrix - query, axis=1)
+        elif distance_strategy == DISTANCE_STRATEGY.COSINE:
+            distances = 1 - (matrix @ query) / (norms * np.linalg.norm(query) + 1e-12)
+        elif distance_strategy == DISTANCE_STRATEGY.MAX_INNER_PRODUCT:
+            distances = -(matrix @ query)
+        else:
+            raise Exception(f"Invalid distance strategy {distance_strategy}")
+
+        # k nearest, then the similarity threshold (mirrors match_node_*)
+        k = min(int(k), len(rows))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+
+        return [
+            NodeReadResult(**rows[i], similarity=float(1 - distances[i]))
+            for i in nearest
+            if 1 - distances[i] > distance_threshold
+        ]
+
+
+# ==============
+# Index registry
+# ==============
+_indexes: Dict[int, ProjectVectorIndex] = {}
+_indexes_lock = RLock()
+
+# One reload per project at a time, concurrent misses wait for it
+_load_locks: Dict[int, Lock] = {}
+_async_load_locks: Dict[int, asyncio.Lock] = {}
+
+
+def is_memory_indexed(project_id: Optional[int]) -> bool:
+    return (
+        LLM_RETRIEVAL_BACKEND == RETRIEVAL_BACKEND.MEMORY
+        and project_id is not None
+        and (not LLM_MEMORY_INDEX_PROJECTS or project_id in LLM_MEMORY_INDEX_PROJECTS)
+    )
+
+
+def get_project_nodes_query(project_id: int):
+    return select(*NODE_COLUMNS).where(
+        Node.project_id == project_id,
+        Node.status == ENTITY_STATUS.ACTIVE.value,
+    )
+
+
+def get_project_version_query(project_id: int):
+    # touch_project() bumps this whenever the project's nodes change
+    return select(Project.updated_at).where(Project.id == project_id)
+
+
+def _load_index(
+    project_id: int, version: Optional[datetime], nodes: Iterable
+) -> ProjectVectorIndex:
+    index = ProjectVectorIndex(project_id, version)
+    index.add(nodes)
+    with _indexes_lock:
+        _indexes[project_id] = index
+    logger.debug(f"🧠 Loaded {len(index)} nodes for project {project_id} into memory")
+    return index
+
+
+def get_project_index(
+    project_id: int, session: Optional[Session] = None
+) -> ProjectVectorIndex:
+    # Fresh indexes are served without a database round trip
+    index = _indexes.get(project_id)
+    if index is not None and index.is_fresh:
+        return index
+
+    with _indexes_lock:
+        load_lock = _load_locks.setdefault(project_id, Lock())
+
+    with load_lock:
+        # Another thread may have reloaded it while we waited
+        index = _indexes.get(project_id)
+        if index is not None and index.is_fresh:
+            return index
+
+        if session:
+            return _refresh_index(project_id, index, session)
+        else:
+            with Session(get_engine()) as session:
+                return _refresh_index(project_id, index, session)
+
+
+def _refresh_index(
+    project_id: int, index: Optional[ProjectVectorIndex], session: Session
+) -> ProjectVectorIndex:
+    version = session.exec(get_project_version_query(project_id)).first()
+    if index is not None and index.version == version:
+        index.renew()
+        return index
+
+    nodes = session.exec(get_project_nodes_query(project_id)).all()
+    return _load_index(project_id, version, nodes)
+
+
+async def get_project_index_async(
+    project_id: int, session: AsyncSession
+) -> ProjectVectorIndex:
+    index = _indexes.get(project_id)
+    if index is not None and index.is_fresh:
+        return index
+
+    load_lock = _async_load_locks.setdefault(project_id, asyncio.Lock())
+    async with load_lock:
+        index = _indexes.get(project_id)
+        if index is not None and index.is_fresh:
+            return index
+
+        version = (await session.exec(get_project_version_query(project_id))).first()
+        if index is not None and index.version == version:
+            index.renew()
+            return index
+
+        nodes = (await session.exec(get_project_nodes_query(project_id))).all()
+        return _load_index(project_id, version, nodes)
+
+
+# ----------------------------------------------------
+# Incremental updates from ingestion in this process.
+# An index that isn't loaded yet will pick rows up on
+# load, other processes catch up through updated_at
+# ----------------------------------------------------
+def add_nodes(project_id: int, nodes: Iterable):
+    index = _indexes.get(project_id)
+    if index is not None:
+        index.add(nodes)
+
+
+def remove_document(project_id: int, document_id: int):
+    index = _indexes.get(project_id)
+    if index is not None:
+        index.remove_document(document_id)
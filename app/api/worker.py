@@ -0,0 +1,276 @@
+'''
+worker.py runs the document ingestion jobs queued by POST /document: reading
+the upload, chunking, embedding and inserting nodes. Jobs live in the
+ingest_job table, so they survive restarts, and any number of worker processes
+can share the queue; each claims jobs with FOR UPDATE SKIP LOCKED.
+
+    python3 worker.py --processes 2
+'''
+from multiprocessing import Process
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from sqlalchemy import update
+from sqlmodel import (
+    Session,
+    select
+)
+from typing import Optional
+import argparse
+import signal
+import socket
+import time
+import os
+
+from helpers import create_document_by_file_path
+from models import (
+    IngestJob,
+    Organization,
+    Project,
+    ensure_vector_index,
+    get_engine
+)
+from config import (
+    INGEST_WORKER_PROCESSES,
+    INGEST_POLL_INTERVAL,
+    INGEST_RETRY_DELAY,
+    INGEST_JOB_TIMEOUT,
+    INGEST_INDEX_CHECK_INTERVAL,
+    JOB_STATUS,
+    logger
+)
+
+_stopping = False
+
+
+def stop(signum, frame):
+    global _stopping
+    _stopping = True
+
+
+# -------------------------------------------------------
+# Claim the oldest due job. SKIP LOCKED lets every worker
+# poll the same queue without blocking on each other
+# -------------------------------------------------------
+def claim_job(worker_id: str) -> Optional[int]:
+    with Session(get_engine()) as session:
+        now = datetime.now()
+        job = session.exec(
+            select(IngestJob)
+            .where(
+                IngestJob.status == JOB_STATUS.QUEUED.value,
+                IngestJob.run_after <= now,
+            )
+            .order_by(IngestJob.run_after)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+
+        if not job:
+            return None
+
+        job.status = JOB_STATUS.RUNNING.value
+        job.attempts += 1
+        job.worker_id = worker_id
+        job.heartbeat_at = now
+        job.updated_at = now
+        session.add(job)
+        session.commit()
+        return job.id
+
+
+# -------------------------------------------------------
+# Hand RUNNING jobs whose worker died back to the queue
+# -------------------------------------------------------
+def requeue_stale_jobs():
+    cutoff = datetime.now() - timedelta(seconds=INGEST_JOB_TIMEOUT)
+    stale = (
+        IngestJob.status == JOB_STATUS.RUNNING.value,
+        IngestJob.heartbeat_at < cutoff,
+    )
+
+    with Session(get_engine()) as session:
+        failed = session.execute(
+            update(IngestJob)
+            .where(*stale, IngestJob.attempts >= IngestJob.max_attempts)
+            .values(
+                status=JOB_STATUS.FAILED.value,
+                error="Worker stopped responding",
+                finished_at=datetime.now(),
+                updated_at=datetime.now(),
+            )
+            .returning(IngestJob.file_path)
+        ).scalars().all()
+        result = session.execute(
+            update(IngestJob)
+            .where(*stale)
+            .values(
+                status=JOB_STATUS.QUEUED.value,
+                run_after=datetime.now(),
+                updated_at=datetime.now(),
+            )
+        )
+        session.commit()
+
+    for file_path in failed:
+        remove_upload(file_path)
+
+    if result.rowcount:
+        logger.warning(f"⏰ Requeued {result.rowcount} stale ingest job(s)")
+
+
+# ------------------------------------------------------
+# Job state updates. Each one is guarded by worker_id, so
+# a worker whose job was requeued can't overwrite it
+# ------------------------------------------------------
+def update_job(job_id: int, worker_id: str, **values):
+    with Session(get_engine()) as session:
+        session.execute(
+            update(IngestJob)
+            .where(IngestJob.id == job_id, IngestJob.worker_id == worker_id)
+            .values(updated_at=datetime.now(), **values)
+        )
+        session.commit()
+
+
+def remove_upload(file_path: str):
+    # Nothing will read the upload once its job has given up for good
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def fail_job(job: IngestJob, worker_id: str, error: Exception):
+    # Client errors (duplicate upload, missing file) won't succeed on a retry
+    retryable = not (isinstance(error, HTTPException) and error.status_code < 500)
+    message = getattr(error, "detail", None) or repr(error)
+
+    if retryable and job.attempts < job.max_attempts:
+        delay = INGEST_RETRY_DELAY * 2 ** (job.attempts - 1)
+        logger.warning(f"🔁 Ingest job {job.uuid} failed, retrying in {delay}s: {message}")
+        update_job(
+            job.id,
+            worker_id,
+            status=JOB_STATUS.QUEUED.value,
+            error=message,
+            run_after=datetime.now() + timedelta(seconds=delay),
+        )
+    else:
+        logger.error(f"🚨 Ingest job {job.uuid} failed: {message}")
+        update_job(
+            job.id,
+            worker_id,
+            status=JOB_STATUS.FAILED.value,
+            error=message,
+            finished_at=datetime.now(),
+        )
+        remove_upload(job.file_path)
+
+
+# -----------
+# Run one job
+# -----------
+def run_job(job_id: int, worker_id: str):
+    with Session(get_engine()) as session:
+        job = session.get(IngestJob, job_id)
+        organization = session.get(Organization, job.organization_id)
+        project = session.get(Project, job.project_id)
+        logger.info(f"📥 Ingesting {job.file_name} for job {job.uuid} (attempt {job.attempts})")
+
+        def on_progress(done: int, total: int):
+            # Doubles as the heartbeat that keeps the job from being requeued
+            update_job(
+                job_id,
+                worker_id,
+                progress_done=done,
+                progress_total=total,
+                heartbeat_at=datetime.now(),
+            )
+
+        try:
+            document = create_document_by_file_path(
+                organization=organization,
+                project=project,
+                file_path=job.file_path,
+                file_hash=job.file_hash,
+                url=job.url,
+                overwrite=job.overwrite,
+                session=session,
+                on_progress=on_progress,
+            )
+        except Exception as e:
+            session.rollback()
+            fail_job(job, worker_id, e)
+            return
+
+        update_job(
+            job_id,
+            worker_id,
+            status=JOB_STATUS.SUCCEEDED.value,
+            document_id=document.id,
+            error=None,
+            finished_at=datetime.now(),
+        )
+        logger.info(f"✅ Ingest job {job.uuid} done, document {document.uuid}")
+
+
+# ---------------------
+# Worker process loop
+# ---------------------
+def run_worker():
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"👷 Ingest worker {worker_id} started")
+
+    # ------------------------------------------------------
+    # The vector index check (ANALYZE, a full count, maybe a
+    # build) is too heavy to run after every job, so it runs
+    # at most once per interval and only after new ingests
+    # ------------------------------------------------------
+    last_index_check = time.monotonic()
+    ingested_since_check = False
+
+    while not _stopping:
+        job_id = claim_job(worker_id)
+        if job_id is None:
+            requeue_stale_jobs()
+        else:
+            run_job(job_id, worker_id)
+            ingested_since_check = True
+
+        if (
+            ingested_since_check
+            and time.monotonic() - last_index_check >= INGEST_INDEX_CHECK_INTERVAL
+        ):
+            ensure_vector_index()
+            last_index_check = time.monotonic()
+            ingested_since_check = False
+
+        if job_id is None:
+            time.sleep(INGEST_POLL_INTERVAL)
+
+    logger.info(f"👷 Ingest worker {worker_id} stopped")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RasaGPT document ingestion worker')
+    parser.add_argument('--processes', type=int, default=INGEST_WORKER_PROCESSES)
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker()
+    else:
+        # Engines are created lazily, so each process opens its own pool
+        processes = [Process(target=run_worker) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+
+        def stop_processes(signum, frame):
+            for process in processes:
+                process.terminate()
+
+        signal.signal(signal.SIGTERM, stop_processes)
+        signal.signal(signal.SIGINT, stop_processes)
+        for process in processes:
+            process.join()